@@ -0,0 +1,101 @@
+import os
+import atexit
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+
+
+class SharedShapeCache:
+    """
+    Shape point sets resident in shared memory, shared by the data loader workers.
+
+    A shape is loaded once, by the first process that misses it, and stored as a float32 .npy in a
+    folder of root (/dev/shm, a tmpfs). Every process then memory-maps the same pages. The folder
+    is capped at capacity MB: once full, the least recently used shapes (by modification time,
+    refreshed on every hit) are removed until low_water of the capacity is used. Hits, misses,
+    evictions and the used bytes are counted across processes. The folder is removed when the
+    creating process exits.
+    """
+
+    def __init__(self, capacity, root='/dev/shm', low_water=0.9):
+        if not os.path.isdir(root):
+            root = tempfile.gettempdir()
+        self.path = tempfile.mkdtemp(prefix='igr_shapes_', dir=root)
+        self.capacity = int(capacity * 2 ** 20)
+        self.low_water = low_water
+        self.lock = multiprocessing.Lock()
+        self.counters = {name: multiprocessing.Value('q', 0, lock=False) for name in ['hits', 'misses', 'evictions', 'used']}
+        self.owner = os.getpid()
+        atexit.register(self.close)
+
+    def get_file(self, key):
+        return os.path.join(self.path, key.replace('/', '__') + '.npy')
+
+    def get(self, key, load):
+        """
+        The cached points of key, or load() (a float32 array) stored in the cache.
+        """
+        filename = self.get_file(key)
+        try:
+            points = np.load(filename, mmap_mode='r')
+            os.utime(filename)
+            with self.lock:
+                self.counters['hits'].value += 1
+            return points
+        except FileNotFoundError:
+            pass
+
+        points = np.ascontiguousarray(load(), dtype=np.float32)
+
+        # shapes larger than the cache are not kept
+        if points.nbytes > self.capacity:
+            with self.lock:
+                self.counters['misses'].value += 1
+            return points
+
+        # written outside the lock, only the rename and the accounting are serialized
+        tmp_filename = '{0}.{1}.tmp.npy'.format(filename, os.getpid())
+        np.save(tmp_filename, points)
+
+        with self.lock:
+            self.counters['misses'].value += 1
+            # another worker may have stored it meanwhile
+            if os.path.exists(filename):
+                os.remove(tmp_filename)
+                return points
+
+            os.replace(tmp_filename, filename)
+            self.counters['used'].value += os.path.getsize(filename)
+
+            if self.counters['used'].value > self.capacity:
+                self.evict(self.low_water * self.capacity)
+
+        return points
+
+    def evict(self, target):
+        # called with the lock held, mapped pages of removed files stay valid for their readers
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp.npy'):
+                continue
+            stat = os.stat(os.path.join(self.path, name))
+            entries.append((stat.st_mtime_ns, stat.st_size, name))
+
+        for _, size, name in sorted(entries):
+            if self.counters['used'].value <= target:
+                break
+            os.remove(os.path.join(self.path, name))
+            self.counters['used'].value -= size
+            self.counters['evictions'].value += 1
+
+    def stats(self):
+        stats = {name: value.value for name, value in self.counters.items()}
+        accesses = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / accesses if accesses > 0 else 0.0
+        stats['used'] = stats['used'] / 2 ** 20
+        return stats
+
+    def close(self):
+        if os.getpid() == self.owner and os.path.isdir(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
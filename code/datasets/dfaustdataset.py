@@ -3,17 +3,29 @@ import torch.utils.data as data
 import numpy as np
 import os
 import utils.general as utils
+from datasets.shards import ShardReader, sample_rows
+from datasets.cache import SharedShapeCache
 
 
 class DFaustDataSet(data.Dataset):
 
-    def __init__(self, dataset_path, split, points_batch=16384, d_in=3, with_gt=False, with_normals=False):
+    def __init__(self, dataset_path, split, points_batch=16384, d_in=3, with_gt=False, with_normals=False, cache_size=0):
 
         base_dir = os.path.abspath(dataset_path)
-        self.npyfiles_mnfld = get_instance_filenames(base_dir, split)
+
+        # float32 shards written by preprocess/dfaust.py --format shards, one .npy per shape otherwise
+        self.shards = ShardReader(os.path.join(base_dir, 'shards')) if ShardReader.exists(os.path.join(base_dir, 'shards')) else None
+
+        self.npyfiles_mnfld = get_instance_filenames(base_dir, split, shards=self.shards)
         self.points_batch = points_batch
         self.with_normals = with_normals
         self.d_in = d_in
+        self.shard_names = [os.path.relpath(f, base_dir)[:-len('.npy')] for f in self.npyfiles_mnfld]
+        self.rng = None
+        self.rng_seed = None
+
+        # opt-in, shapes resident in shared memory for all the data loader workers, cache_size in MB
+        self.cache = SharedShapeCache(cache_size) if cache_size > 0 else None
 
         if with_gt:
             self.scans_files = get_instance_filenames(utils.concat_home_dir('datasets/dfaust/scans'), split, '','ply')
@@ -21,7 +33,22 @@ class DFaustDataSet(data.Dataset):
             self.shapenames = [x.split('/')[-1].split('.ply')[0] for x in self.scans_files]
 
     def load_points(self, index):
-        return np.load(self.npyfiles_mnfld[index])
+        if not self.cache is None:
+            return self.cache.get(self.shard_names[index], lambda: self.read_points(index))
+        return self.read_points(index)
+
+    def read_points(self, index):
+        # memory-mapped, only the rows that are read are loaded
+        if not self.shards is None and self.shard_names[index] in self.shards:
+            return self.shards.get_points(self.shard_names[index])
+        return np.load(self.npyfiles_mnfld[index], mmap_mode='r')
+
+    def get_rng(self):
+        # seeded from torch, which the data loader seeds differently in every worker
+        if self.rng_seed != torch.initial_seed():
+            self.rng_seed = torch.initial_seed()
+            self.rng = np.random.default_rng(self.rng_seed)
+        return self.rng
 
     def get_info(self, index):
         shape_name, pose, tag = self.npyfiles_mnfld[index].split('/')[-3:]
@@ -29,10 +56,8 @@ class DFaustDataSet(data.Dataset):
 
     def __getitem__(self, index):
 
-        point_set_mnlfld = torch.from_numpy(self.load_points(index)).float()
-
-        random_idx = torch.randperm(point_set_mnlfld.shape[0])[:self.points_batch]
-        point_set_mnlfld = torch.index_select(point_set_mnlfld, 0, random_idx)
+        # only points_batch rows are read and converted
+        point_set_mnlfld = torch.from_numpy(sample_rows(self.load_points(index), self.points_batch, self.get_rng()))
 
         if self.with_normals:
             normals = point_set_mnlfld[:, -self.d_in:]  # todo adjust to case when we get no sigmas
@@ -46,7 +71,7 @@ class DFaustDataSet(data.Dataset):
         return len(self.npyfiles_mnfld)
 
 
-def get_instance_filenames(base_dir, split, ext='', format='npy'):
+def get_instance_filenames(base_dir, split, ext='', format='npy', shards=None):
     npyfiles = []
     l = 0
     for dataset in split:
@@ -59,7 +84,7 @@ def get_instance_filenames(base_dir, split, ext='', format='npy'):
 
                     instance_filename = os.path.join(base_dir, class_name, instance_name,
                                                      shape + "{0}.{1}".format(ext, format))
-                    if not os.path.isfile(instance_filename):
+                    if not os.path.isfile(instance_filename) and not (not shards is None and '/'.join([class_name, instance_name, shape]) in shards):
                         print(
                             'Requested non-existent file "' + instance_filename + "' {0} , {1}".format(l, j)
                         )
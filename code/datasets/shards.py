@@ -0,0 +1,112 @@
+import os
+import json
+import numpy as np
+
+INDEX_FILE = 'index.json'
+
+
+class ShardWriter:
+    """
+    Pack the point sets of many shapes into a few raw float32 shard files of about shard_size MB.
+
+    index.json maps every shape name to [shard file, first row, number of rows], written when a
+    shard is completed and on close. Writing into a folder that already has an index appends new
+    shards to it.
+    """
+
+    def __init__(self, path, columns=6, shard_size=1024):
+        self.path = path
+        self.shard_bytes = shard_size * 2 ** 20
+        self.file = None
+
+        if os.path.exists(os.path.join(path, INDEX_FILE)):
+            with open(os.path.join(path, INDEX_FILE)) as f:
+                self.index = json.load(f)
+            if self.index["columns"] != columns:
+                raise Exception('shards of {0} have {1} columns, not {2}'.format(path, self.index["columns"], columns))
+        else:
+            self.index = {"columns": columns, "shards": [], "shapes": {}}
+
+    def __contains__(self, name):
+        return name in self.index["shapes"]
+
+    def add(self, name, points):
+        points = np.ascontiguousarray(points, dtype=np.float32)
+        if points.ndim != 2 or points.shape[1] != self.index["columns"]:
+            raise Exception('shape {0} has points of shape {1}, the shards have {2} columns'.format(name, points.shape, self.index["columns"]))
+
+        if self.file is None or (self.file.tell() > 0 and self.file.tell() + points.nbytes > self.shard_bytes):
+            self.next_shard()
+
+        self.index["shapes"][name] = [self.index["shards"][-1], self.file.tell() // (4 * self.index["columns"]), points.shape[0]]
+        self.file.write(points.tobytes())
+
+    def next_shard(self):
+        self.close_shard()
+        filename = 'shard_{0:05d}.f32'.format(len(self.index["shards"]))
+        self.file = open(os.path.join(self.path, filename), 'wb')
+        self.index["shards"].append(filename)
+
+    def close_shard(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        self.write_index()
+
+    def write_index(self):
+        filename = os.path.join(self.path, INDEX_FILE)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(filename + '.tmp', filename)
+
+    def close(self):
+        self.close_shard()
+        self.write_index()
+
+
+class ShardReader:
+    """
+    Point sets of the shards written by ShardWriter. The shards are memory-mapped on first use in
+    every process (data loader workers included), so only the sampled rows are read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.maps = {}
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, INDEX_FILE))
+
+    def __contains__(self, name):
+        return name in self.index["shapes"]
+
+    def __getstate__(self):
+        # the memory maps are reopened by every worker instead of being pickled
+        state = self.__dict__.copy()
+        state["maps"] = {}
+        return state
+
+    def get_shard(self, filename):
+        if not filename in self.maps:
+            self.maps[filename] = np.memmap(os.path.join(self.path, filename), dtype=np.float32, mode='r').reshape(-1, self.index["columns"])
+        return self.maps[filename]
+
+    def get_points(self, name):
+        shard, start, count = self.index["shapes"][name]
+        return self.get_shard(shard)[start:start + count]
+
+    def sample_points(self, name, count, rng):
+        return sample_rows(self.get_points(name), count, rng)
+
+
+def sample_rows(points, count, rng):
+    # count rows drawn without replacement, without a permutation of all the rows, read in
+    # ascending order so a memory-mapped array is traversed once
+    if count >= points.shape[0]:
+        return np.array(points, dtype=np.float32)
+    rows = np.sort(rng.choice(points.shape[0], count, replace=False))
+    return np.asarray(points[rows], dtype=np.float32)
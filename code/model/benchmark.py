@@ -0,0 +1,119 @@
+import os
+import sys
+project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.append(project_dir)
+os.chdir(project_dir)
+import argparse
+from time import time
+import torch
+from pyhocon import ConfigFactory
+import utils.general as utils
+from model.network import add_latent, forward_point_sets
+from model.sample import Sampler
+
+
+def saved_tensor_bytes(fn):
+    # bytes the autograd graph of fn keeps for the backward pass, counted once per storage
+    storages = {}
+
+    def pack(tensor):
+        storages[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = fn()
+    loss.backward()
+    return sum(storages.values())
+
+
+def add_latent_loop(lat_vecs, points, indices):
+    # the former per shape loop of ShapeSpaceRunner.add_latent, the reference of benchmark_latent
+    batch_size, num_of_points, dim = points.shape
+    points = points.reshape(batch_size * num_of_points, dim)
+    latent_inputs = torch.zeros(0, device=points.device)
+
+    for ind in indices.numpy():
+        latent_ind = lat_vecs[ind]
+        latent_repeat = latent_ind.expand(num_of_points, -1)
+        latent_inputs = torch.cat([latent_inputs, latent_repeat], 0)
+    points = torch.cat([latent_inputs, points], 1)
+    return points
+
+
+def latent_step(network, sampler, lat_vecs, pnts, indices, variant):
+    # one shape space training step with the latents attached by variant
+    nonmnfld_pnts = sampler.get_points(pnts)
+
+    if variant == 'projection':
+        latents = lat_vecs[indices.to(pnts.device)]
+        (mnfld_pred, mnfld_grad), (nonmnfld_pred, nonmnfld_grad) = forward_point_sets(
+            lambda x: network(x, with_gradient=True, latent=latents), [pnts, nonmnfld_pnts], dim=1)
+    else:
+        attach = add_latent_loop if variant == 'loop' else lambda v, x, i: add_latent(x, v[i.to(x.device)])
+        (mnfld_pred, mnfld_grad), (nonmnfld_pred, nonmnfld_grad) = forward_point_sets(
+            lambda x: network(x, with_gradient=True), [attach(lat_vecs, pnts, indices), attach(lat_vecs, nonmnfld_pnts, indices)])
+
+    mnfld_loss = mnfld_pred.abs().mean()
+    grad_loss = ((nonmnfld_grad.norm(2, dim=-1) - 1) ** 2).mean()
+    return mnfld_loss + 0.1 * grad_loss + 1.0e-3 * lat_vecs[indices.to(pnts.device)].norm(dim=1).mean()
+
+
+def benchmark_latent(network, sampler, batch_size, points_batch, steps, latent_size, num_shapes=1000):
+    """
+    Steps per second and graph memory of a shape space training step with the latents attached
+    by the former per shape loop, by one gather and broadcast (add_latent), and through the per
+    shape latent projections of the network (latent=...), which never repeat the latent per point.
+    """
+    device = utils.get_device()
+    lat_vecs = torch.zeros(num_shapes, latent_size, device=device).normal_(0, 1 / latent_size).requires_grad_()
+    pnts = torch.rand(batch_size, points_batch, 3, device=device) * 2 - 1
+    indices = torch.randperm(num_shapes)[:batch_size]
+    optimizer = torch.optim.Adam(list(network.parameters()) + [lat_vecs], lr=1e-5)
+
+    for variant in ['loop', 'gather', 'projection']:
+
+        def step():
+            optimizer.zero_grad()
+            loss = latent_step(network, sampler, lat_vecs, pnts, indices, variant)
+            loss.backward()
+            optimizer.step()
+
+        # warm up, then time
+        step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time()
+        for i in range(steps):
+            step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = time() - start
+
+        optimizer.zero_grad()
+        graph_bytes = saved_tensor_bytes(lambda: latent_step(network, sampler, lat_vecs, pnts, indices, variant))
+
+        print('{0}: {1:.2f} steps/s, graph memory {2:.1f} MB'.format(variant, steps / elapsed, graph_bytes / 2 ** 20))
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--conf', type=str, default='./shapespace/dfaust_setup.conf')
+    arg_parser.add_argument('--points_batch', type=int, default=8000, help='points per shape')
+    arg_parser.add_argument('--steps', type=int, default=20, help='timed training steps per variant')
+    arg_parser.add_argument('--batch_size', type=int, default=16, help='shapes per batch of the latent benchmark')
+
+    args = arg_parser.parse_args()
+
+    conf = ConfigFactory.parse_file(args.conf)
+    utils.set_device_from_conf(conf)
+
+    # shape space configs decode [latent | xyz]
+    latent_size = conf.get_int('train.latent_size')
+    network = utils.get_class(conf.get_string('train.network_class'))(d_in=latent_size + conf.get_int('train.d_in'), **conf.get_config('network.inputs'))
+    network = utils.to_device(network)
+
+    sampler = Sampler.get_sampler(conf.get_string('network.sampler.sampler_type'))(conf.get_float('network.sampler.properties.global_sigma'),
+                                                                                   conf.get_float('network.sampler.properties.local_sigma', 0.01))
+
+    benchmark_latent(network, sampler, args.batch_size, args.points_batch, args.steps, latent_size)
@@ -0,0 +1,102 @@
+import numpy as np
+import torch
+import utils.general as utils
+
+
+class PhaseLoss:
+    """
+    Phase transition loss: lambda * L + integral term + mu * regularization.
+
+    L averages the network over sample_count gaussian samples around every manifold point. Those
+    samples are evaluated in chunks of manifold points sized by memory_budget (MB of activations),
+    and every chunk is backpropagated as soon as it is evaluated. Only one chunk of local samples
+    is alive at a time, the parameter gradients accumulate, so the optimizer has to be zeroed before
+    calling the loss and stepped after backpropagating the returned loss.
+    """
+
+    def __init__(self, decoder, epsilon, lambda_, mu, sample_count, sampling_sigma, chunk_size, scaler=None):
+        self.decoder = decoder
+        self.epsilon = epsilon
+        self.lambda_ = lambda_
+        self.mu = mu
+        self.sample_count = sample_count
+        self.sampling_sigma = sampling_sigma
+        self.chunk_size = chunk_size
+        # GradScaler of fp16 training, the chunks are backpropagated with the same scale as the loss
+        self.scaler = scaler
+
+    @staticmethod
+    def from_conf(decoder, network, conf, scaler=None):
+        # conf is the network.loss block
+        sample_count = conf.get_int('sample_count')
+        return PhaseLoss(decoder,
+                         epsilon=conf.get_float('epsilon'),
+                         lambda_=conf.get_float('lambda'),
+                         mu=conf.get_float('mu'),
+                         sample_count=sample_count,
+                         sampling_sigma=conf.get_float('sampling_sigma'),
+                         chunk_size=PhaseLoss.get_chunk_size(network, sample_count, conf.get_float('memory_budget', 1024)),
+                         scaler=scaler)
+
+    @staticmethod
+    def get_chunk_size(network, sample_count, memory_budget):
+        # manifold points per chunk, roughly three floats per unit (linear input, activation input and
+        # output) kept for the backward pass by every local sample
+        widths = [m.out_features for m in network.modules() if isinstance(m, torch.nn.Linear)]
+        bytes_per_sample = 4 * (3 + 3 * sum(widths))
+        return max(1, int(memory_budget * 2 ** 20 // (bytes_per_sample * sample_count)))
+
+    def local_term(self, mnfld_pnts):
+        """
+        L = mean over manifold points of |mean of the decoder over the local samples|. With grad
+        enabled, every chunk is backpropagated (scaled by lambda) on the spot. Returns L detached.
+        """
+        num_points = mnfld_pnts.shape[0]
+        L = torch.zeros((), device=mnfld_pnts.device)
+
+        for chunk in torch.split(mnfld_pnts.detach(), self.chunk_size, dim=0):
+            # noise drawn on the device of the points
+            local_x = chunk.unsqueeze(dim=1) + torch.randn((chunk.shape[0], self.sample_count, chunk.shape[1]), device=chunk.device) * self.sampling_sigma
+            local_u = self.decoder(local_x)
+
+            L_chunk = torch.abs(torch.mean(local_u, dim=1)).sum() / num_points
+
+            if torch.is_grad_enabled() and L_chunk.requires_grad:
+                chunk_loss = self.lambda_ * L_chunk
+                if not self.scaler is None:
+                    chunk_loss = self.scaler.scale(chunk_loss)
+                chunk_loss.backward()
+            L = L + L_chunk.detach()
+
+        return L
+
+    def __call__(self, mnfld_pnts, mnfld_pred, mnfld_grad, normals=None):
+        """
+        Returns (loss, reconstruction_loss, regularization_loss). The local term is already
+        backpropagated and enters loss as a constant, backpropagating loss adds the remaining terms.
+        """
+        u = mnfld_pred  # [B, 1]
+
+        # reconstruction term 1 (L)
+        L = self.local_term(mnfld_pnts)
+
+        # reconstruction term 2
+        norm_grad_u = mnfld_grad.norm(2, dim=-1)  # [B, ]
+        W = utils.potential(u)  # [B, 1]
+        integral_term = torch.mean((self.epsilon * torch.pow(norm_grad_u, 2)) + W)
+
+        reconstruction_loss = (self.lambda_ * L) + integral_term
+
+        # regularization term on w = -sqrt(epsilon) * log|1 - sum(u)| * sign(u), the gradient of sum(w)
+        # w.r.t. the points in closed form, sign(u) is piecewise constant
+        grad_w = np.sqrt(self.epsilon) * torch.sum(torch.sign(u)) / (1 - torch.sum(u.squeeze())) * mnfld_grad
+        norm_grad_w = grad_w.norm(2, dim=-1)
+
+        if not normals is None:
+            regularization_loss = torch.mean(torch.pow((normals - grad_w).norm(2, dim=-1), 2))
+        else:
+            regularization_loss = torch.mean(torch.pow(1 - norm_grad_w, 2))
+
+        loss = reconstruction_loss + (self.mu * regularization_loss)
+
+        return loss, reconstruction_loss, regularization_loss
@@ -1,6 +1,7 @@
 import numpy as np
 import torch.nn as nn
 import torch
+import torch.nn.functional as F
 from torch.autograd import grad
 
 
@@ -12,10 +13,47 @@ def gradient(inputs, outputs):
         grad_outputs=d_points,
         create_graph=True,
         retain_graph=True,
-        only_inputs=True)[0][:, -3:]
+        only_inputs=True)[0][..., -3:]
     return points_grad
 
 
+def forward_point_sets(forward, point_sets, dim=0):
+    """
+    Evaluate forward, returning (values, gradients), once on the concatenation of point_sets along dim
+    and split the outputs back into one (values, gradients) pair per set.
+    """
+    sizes = [pnts.shape[dim] for pnts in point_sets]
+    pred, grad = forward(torch.cat(point_sets, dim=dim))
+    return list(zip(torch.split(pred, sizes, dim=dim), torch.split(grad, sizes, dim=dim)))
+
+
+def add_latent(points, latents):
+    # (B * N, L + D) [latent | xyz] inputs of (B, N, D) points with one (B, L) latent per shape, broadcast in one cat
+    batch_size, num_of_points, dim = points.shape
+    return torch.cat([latents.unsqueeze(1).expand(-1, num_of_points, -1), points], dim=-1).reshape(batch_size * num_of_points, -1)
+
+
+def get_latent_decoder(network, latent, with_gradient=False):
+    # decoder of xyz only batches for a fixed latent, reusing the cached latent projection when available
+    net = getattr(network, 'module', network)
+    if hasattr(net, 'with_latent'):
+        return net.with_latent(latent, with_gradient)
+
+    def decode(pnts):
+        latent_size = latent.shape[-1]
+        if pnts.dim() == 3:
+            latent_all = latent.reshape(-1, 1, latent_size).expand(pnts.shape[0], pnts.shape[1], -1)
+        else:
+            latent_all = latent.reshape(1, latent_size).expand(pnts.shape[0], -1)
+        if with_gradient:
+            pnts = pnts.requires_grad_()
+            pred = network(torch.cat([latent_all, pnts], dim=-1))
+            return pred, gradient(pnts, pred)
+        return network(torch.cat([latent_all, pnts], dim=-1))
+
+    return decode
+
+
 class ImplicitNet(nn.Module):
     def __init__(
         self,
@@ -32,6 +70,7 @@ class ImplicitNet(nn.Module):
 
         self.num_layers = len(dims)
         self.skip_in = skip_in
+        self.d_in = d_in
 
         for layer in range(0, self.num_layers - 1):
 
@@ -63,7 +102,19 @@ class ImplicitNet(nn.Module):
         else:
             self.activation = nn.ReLU()
 
-    def forward(self, input):
+    def forward(self, input, with_gradient=False, latent=None):
+        """
+        SDF of the input points. With with_gradient, also returns the exact gradient with
+        respect to the last 3 input coordinates (xyz), see forward_with_gradient.
+
+        With latent (K, latent_size), input is (K, N, 3) xyz and every shape is conditioned through the
+        projection of its latent (see forward_xyz), so the latent is never repeated per point.
+        """
+        if not latent is None:
+            return self.forward_xyz(input, self.project_latent(latent), with_gradient)
+
+        if with_gradient:
+            return self.forward_with_gradient(self.forward, input)
 
         x = input
 
@@ -79,4 +130,77 @@ class ImplicitNet(nn.Module):
             if layer < self.num_layers - 2:
                 x = self.activation(x)
 
-        return x
+        # half precision under autocast, the losses get the input precision
+        return x.to(input.dtype)
+
+    def forward_with_gradient(self, forward, input):
+        """
+        forward(input) and its gradient with respect to xyz (the last 3 input coordinates), through
+        autograd.grad. The gradient is differentiable (create_graph) when grad mode is on, so losses
+        on it train the network. Returns (..., 1) values and (..., 3) gradients.
+        """
+        create_graph = torch.is_grad_enabled()
+        with torch.enable_grad():
+            if not input.requires_grad:
+                input = input.detach().requires_grad_()
+            pred = forward(input)
+            points_grad = grad(outputs=pred, inputs=input, grad_outputs=torch.ones_like(pred), create_graph=create_graph)[0][..., -3:]
+        return pred, points_grad
+
+    def project_latent(self, latent):
+        """
+        Precompute the contribution of latent codes to the layers that see the input,
+        i.e. lin0 and the skip layers, biases included.
+
+        latent is (latent_size) or (K, latent_size); returns {layer: (K, out_dim)}.
+        """
+        latent = latent.reshape(-1, latent.shape[-1])
+        latent_size = latent.shape[-1]
+        projections = {}
+
+        for layer in [0] + list(self.skip_in):
+            lin = getattr(self, "lin" + str(layer))
+
+            if layer == 0:
+                projections[layer] = F.linear(latent, lin.weight[:, :latent_size], lin.bias)
+            else:
+                start = lin.in_features - self.d_in
+                projections[layer] = F.linear(latent / np.sqrt(2), lin.weight[:, start:start + latent_size], lin.bias)
+
+        return projections
+
+    def forward_xyz(self, xyz, projections, with_gradient=False):
+        """
+        Same as forward on [latent | xyz] inputs given projections = project_latent(latent).
+        xyz is (N, 3) for a single latent or (K, N, 3) with one latent per leading index.
+        With with_gradient, also returns the gradient as in forward_with_gradient.
+        """
+        if with_gradient:
+            return self.forward_with_gradient(lambda x: self.forward_xyz(x, projections), xyz)
+
+        x = xyz
+        latent_size = self.d_in - xyz.shape[-1]
+
+        for layer in range(0, self.num_layers - 1):
+
+            lin = getattr(self, "lin" + str(layer))
+
+            if layer in projections:
+                projection = projections[layer].unsqueeze(1) if xyz.dim() == 3 else projections[layer]
+
+            if layer == 0:
+                x = F.linear(xyz, lin.weight[:, latent_size:]) + projection
+            elif layer in self.skip_in:
+                start = lin.in_features - self.d_in
+                x = F.linear(x / np.sqrt(2), lin.weight[:, :start]) + F.linear(xyz / np.sqrt(2), lin.weight[:, start + latent_size:]) + projection
+            else:
+                x = lin(x)
+
+            if layer < self.num_layers - 2:
+                x = self.activation(x)
+
+        return x.to(xyz.dtype)
+
+    def with_latent(self, latent, with_gradient=False):
+        projections = self.project_latent(latent)
+        return lambda xyz: self.forward_xyz(xyz, projections, with_gradient)
@@ -34,3 +34,53 @@ class NormalPerPoint(Sampler):
         sample = torch.cat([sample_local, sample_global], dim=1)
 
         return sample
+
+
+class PointBatchSampler:
+    """
+    Minibatches over every point of a cloud, pass after pass.
+
+    At the start of each pass the tensors (same first dimension, e.g. points and their local sigmas)
+    are permuted once on their device, the batches are then contiguous slices of the permuted copies,
+    so every point is seen once per pass and a step costs no host permutation nor index gather. A
+    batch running past the end of a pass is completed from the next one.
+    """
+
+    def __init__(self, batch_size, **tensors):
+        self.batch_size = batch_size
+        self.tensors = tensors
+        self.num_points = next(iter(tensors.values())).shape[0]
+        self.device = next(iter(tensors.values())).device
+        self.shuffled = None
+        self.position = 0
+        self.consumed = 0
+
+    @property
+    def passes(self):
+        # passes over the cloud so far, fractional
+        return self.consumed / self.num_points
+
+    def skip(self, steps):
+        # account for the batches of a resumed run
+        self.consumed += steps * self.batch_size
+
+    def shuffle(self):
+        permutation = torch.randperm(self.num_points, device=self.device)
+        self.shuffled = {key: tensor[permutation] for key, tensor in self.tensors.items()}
+        self.position = 0
+
+    def next(self):
+        parts = []
+        remaining = self.batch_size
+        while remaining > 0:
+            if self.shuffled is None or self.position >= self.num_points:
+                self.shuffle()
+            count = min(remaining, self.num_points - self.position)
+            parts.append({key: tensor[self.position:self.position + count] for key, tensor in self.shuffled.items()})
+            self.position += count
+            remaining -= count
+
+        self.consumed += self.batch_size
+        if len(parts) == 1:
+            return parts[0]
+        return {key: torch.cat([part[key] for part in parts], dim=0) for key in self.tensors}
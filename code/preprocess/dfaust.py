@@ -12,6 +12,7 @@ import os
 import numpy as np
 import json
 import utils.general as utils
+from datasets.shards import ShardWriter
 
 SAMPLES = 250000
 
@@ -24,6 +25,9 @@ if __name__ == '__main__':
     parser.add_argument('--mode', required=False, default=None, type=int, help='0 for train only 1 for test only')
     parser.add_argument('--names', required=False, default=None, type=str, help='format: 50002,50020,50021; o.w. all')
     parser.add_argument('--skip', default=False, action="store_true", help='skip if already exists')
+    parser.add_argument('--format', default='npy', choices=['npy', 'shards'], help='one npy per shape or packed float32 shards')
+    parser.add_argument('--shard-size', default=1024, type=int, help='shard size in MB')
+    parser.add_argument('--pack', default=False, action="store_true", help='pack the existing npy outputs into shards instead of sampling the scans')
 
     code_path = os.path.abspath(os.curdir)
 
@@ -60,6 +64,12 @@ if __name__ == '__main__':
         counterc = 0
         scale = 1
 
+        shards = None
+        if args.format == 'shards':
+            utils.mkdir_ifnotexists(os.path.join(os.path.abspath(args.out_path), 'dfaust_processed'))
+            utils.mkdir_ifnotexists(os.path.join(os.path.abspath(args.out_path), 'dfaust_processed', 'shards'))
+            shards = ShardWriter(os.path.join(os.path.abspath(args.out_path), 'dfaust_processed', 'shards'), shard_size=args.shard_size)
+
         # os.chdir('/home/atzmonm/data/')
         for ds,cat_det in train_split['scans'].items():
             if names and ds not in names:
@@ -83,7 +93,14 @@ if __name__ == '__main__':
                     counterc = counterc + 1
                     output_file = os.path.join(output,ds,cat,shape)
                     print (output_file)
-                    if not (args.skip and os.path.isfile(output_file + '.npy')):
+                    if not shards is None:
+                        name = '/'.join([ds, cat, shape])
+                        if args.skip and name in shards:
+                            continue
+                        if args.pack:
+                            shards.add(name, np.load(output_file + '.npy', mmap_mode='r'))
+                            continue
+                    if not (args.skip and os.path.isfile(output_file + '.npy')) or not shards is None:
                         print ('loading : {0}'.format(os.path.join(source,shape)))
                         mesh = trimesh.load(os.path.join(source,shape) + '.ply')
                         sample = sample_surface(mesh,SAMPLES)
@@ -94,8 +111,14 @@ if __name__ == '__main__':
                         pnts = pnts - np.expand_dims(center, axis=0)
                         point_set = np.hstack([pnts, normals])
 
-                        np.save(output_file + '.npy', point_set)
+                        if not shards is None:
+                            shards.add(name, point_set)
+                        else:
+                            np.save(output_file + '.npy', point_set)
 
                         np.save(output_file + '_normalization.npy', {"center":center,"scale":scale})
 
+        if not shards is None:
+            shards.close()
+
     print ("end!")
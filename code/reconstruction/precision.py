@@ -0,0 +1,129 @@
+import os
+import sys
+project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.append(project_dir)
+os.chdir(project_dir)
+import argparse
+from time import time
+import numpy as np
+import torch
+from pyhocon import ConfigFactory
+import utils.general as utils
+import utils.plots as plt
+import utils.metrics as metrics
+from model.sample import Sampler, PointBatchSampler
+from utils.pointcloud import load_point_clouds, get_local_sigma
+
+
+def load_cloud(filename):
+    # centered and scaled into the unit cube, Chamfer distances are comparable across the clouds
+    data = torch.from_numpy(np.array(load_point_clouds(filename, cache=False), dtype=np.float32))
+    data[:, :3] = data[:, :3] - data[:, :3].mean(dim=0)
+    data[:, :3] = data[:, :3] / data[:, :3].abs().max()
+    return utils.to_device(data)
+
+
+def train(network, conf, data, precision, steps, points_batch):
+    # IGR training of network on data, the network under autocast in the given precision
+    utils.set_precision(precision)
+    scaler = utils.get_grad_scaler()
+    sampler = Sampler.get_sampler(conf.get_string('network.sampler.sampler_type'))(conf.get_float('network.sampler.properties.global_sigma'))
+    sigma = utils.to_device(torch.from_numpy(get_local_sigma(data.cpu().numpy(), conf.get_int('network.sampler.properties.local_sigma_k', 50))))
+    batches = PointBatchSampler(points_batch, data=data, sigma=sigma)
+    optimizer = torch.optim.Adam(network.parameters(), lr=conf.get_list('train.learning_rate_schedule')[0]['Initial'])
+    with_normals = data.shape[-1] >= 6
+
+    start = time()
+    for step in range(steps):
+        batch = batches.next()
+        mnfld_pnts = batch["data"][:, :3]
+        nonmnfld_pnts = sampler.get_points(mnfld_pnts.unsqueeze(0), batch["sigma"].unsqueeze(0)).squeeze(0)
+
+        optimizer.zero_grad()
+        with utils.autocast():
+            mnfld_pred, mnfld_grad = network(mnfld_pnts, with_gradient=True)
+            nonmnfld_pred, nonmnfld_grad = network(nonmnfld_pnts, with_gradient=True)
+
+        loss = mnfld_pred.abs().mean() + conf.get_float('network.loss.lambda') * ((nonmnfld_grad.norm(2, dim=-1) - 1) ** 2).mean()
+        if with_normals:
+            loss = loss + conf.get_float('network.loss.normals_lambda') * ((mnfld_grad - batch["data"][:, 3:6]).abs()).norm(2, dim=1).mean()
+
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+    return time() - start
+
+
+def extract(network, data, precision, resolution):
+    # dense grid evaluation of network in the given precision, returns the mesh and the decoding time
+    utils.set_precision(precision)
+    with torch.no_grad():
+        network.eval()
+        start = time()
+        surface = plt.get_surface(data[:, :3], network, None, resolution, 0, False, False, 'dense')
+        elapsed = time() - start
+        network.train()
+    return plt.build_surface_trace(surface, 0, True)["mesh_export"], elapsed
+
+
+def chamfer(mesh, points):
+    if mesh is None:
+        return float('nan')
+    return metrics.mesh_metrics(mesh, points)["chamfer_l1"]
+
+
+def validate_precision(conf, filenames, precision, steps, points_batch, resolution):
+    """
+    For every cloud, train the same initial network in fp32 and in precision, and report:
+    the decoding speedup of the grid evaluation, the Chamfer drift of the fp32 network decoded in
+    precision against its fp32 decoding, and of the network trained in precision against the fp32
+    trained one, plus the Chamfer of both trained networks to the input points.
+    """
+    for filename in filenames:
+        data = load_cloud(filename)
+        points = data[:, :3].cpu().numpy()
+
+        torch.manual_seed(0)
+        reference = utils.to_device(utils.get_class(conf.get_string('train.network_class'))(d_in=3, **conf.get_config('network.inputs')))
+        network = utils.to_device(utils.get_class(conf.get_string('train.network_class'))(d_in=3, **conf.get_config('network.inputs')))
+        network.load_state_dict(reference.state_dict())
+
+        reference_train_time = train(reference, conf, data, 'fp32', steps, points_batch)
+        train_time = train(network, conf, data, precision, steps, points_batch)
+
+        reference_mesh, reference_time = extract(reference, data, 'fp32', resolution)
+        decoded_mesh, decode_time = extract(reference, data, precision, resolution)
+        trained_mesh, _ = extract(network, data, precision, resolution)
+
+        reference_samples = reference_mesh.vertices if not reference_mesh is None else points
+
+        print('{0}: training {1:.2f}x, decoding {2:.2f}x, decoding drift {3:.6f}, training drift {4:.6f}, '
+              'chamfer to points fp32 {5:.6f} / {6} {7:.6f}'.format(
+                  os.path.basename(filename),
+                  reference_train_time / train_time,
+                  reference_time / decode_time,
+                  chamfer(decoded_mesh, reference_samples),
+                  chamfer(trained_mesh, reference_samples),
+                  chamfer(reference_mesh, points),
+                  precision,
+                  chamfer(trained_mesh, points)))
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--conf', type=str, default='./reconstruction/setup.conf')
+    arg_parser.add_argument('--precision', type=str, default='bf16', help='mixed precision compared to fp32')
+    arg_parser.add_argument('--steps', type=int, default=1000, help='training steps per cloud and precision')
+    arg_parser.add_argument('--points_batch', type=int, default=4096, help='point batch size')
+    arg_parser.add_argument('--resolution', type=int, default=128, help='grid resolution of the decoding')
+    arg_parser.add_argument('--clouds', type=str, nargs='+',
+                            default=['../data/bunny_normals_10000.xyz', '../data/armadillo_normals_10000.xyz', '../data/dragon_20000.xyz'])
+
+    args = arg_parser.parse_args()
+
+    conf = ConfigFactory.parse_file(args.conf)
+    utils.set_device_from_conf(conf)
+
+    validate_precision(conf, args.clouds, args.precision, args.steps, args.points_batch, args.resolution)
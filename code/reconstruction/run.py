@@ -10,14 +10,15 @@ import argparse
 import GPUtil
 import torch
 import utils.general as utils
-from model.sample import Sampler
-from model.network import gradient
-from scipy.spatial import cKDTree
-from utils.plots import plot_surface, plot_cuts
+from model.sample import Sampler, PointBatchSampler
+from model.loss import PhaseLoss
+from model.network import gradient, forward_point_sets
+from utils.pointcloud import get_local_sigma, get_cache_dir
+from utils.plots import plot_surface, plot_cuts, plot_training_metrics
+from utils.metrics import MetricLogger, format_metrics
+from utils.artifacts import get_artifact_writer
+from utils.checkpoints import CheckpointManager, load_checkpoint
 from tqdm import tqdm
-import matplotlib.pyplot as plt 
-import seaborn as sns 
-sns.set_style("darkgrid")
 
 class ReconstructionRunner:
 
@@ -25,8 +26,7 @@ class ReconstructionRunner:
 
         print("running")
 
-        self.data = self.data.cuda()
-        self.data.requires_grad_()
+        self.data = utils.to_device(self.data).contiguous()
 
         if self.eval:
 
@@ -36,28 +36,24 @@ class ReconstructionRunner:
             utils.mkdir_ifnotexists(os.path.join(self.cur_exp_dir, 'evaluation'))
             utils.mkdir_ifnotexists(my_path)
             self.plot_shapes(epoch=self.startepoch, path=my_path, with_cuts=True)
+            self.close_writer()
             return
 
         print("training")
 
-        loss_dict = {"loss": []}
+        # an epoch is one minibatch, the batches go through the whole cloud once per pass
+        tensors = {"data": self.data}
         if (self.conf.get_string('network.loss.type') == "IGR"):
-            loss_dict["manifold_loss"] = []
-            loss_dict["eikonal_loss"] = []
-
-        elif (self.conf.get_string('network.loss.type') == "phase"):
-            loss_dict["reconstruction_loss"] = []
-            loss_dict["regularization_loss"] = []
+            tensors["sigma"] = self.local_sigma
+        batches = PointBatchSampler(self.points_batch, **tensors)
+        batches.skip(self.startepoch)
 
         for epoch in tqdm(range(self.startepoch, self.nepochs + 1)):
-            print(f"epoch = {epoch}")
-
-            indices = torch.tensor(np.random.choice(self.data.shape[0], self.points_batch, False))
 
-            cur_data = self.data[indices]
+            batch = batches.next()
+            cur_data = batch["data"]
 
             mnfld_pnts = cur_data[:, :self.d_in]
-            mnfld_sigma = self.local_sigma[indices]
 
             if epoch % self.conf.get_int('train.checkpoint_frequency') == 0:
                 print('saving checkpoint: ', epoch)
@@ -69,27 +65,21 @@ class ReconstructionRunner:
             self.network.train()
             self.adjust_learning_rate(epoch)
 
-            # forward pass
+            # zeroed before the forward pass, the phase loss accumulates gradients while evaluating
+            self.optimizer.zero_grad()
+
             if (self.conf.get_string('train.encoding') == "FF"):
                 mnfld_pnts = torch.fft.fft(mnfld_pnts).real
-                mnfld_pred = torch.fft.ifft(self.network(mnfld_pnts)).real
-
-            else:
-                mnfld_pred = self.network(mnfld_pnts)
-
-            # compute grad
-            mnfld_grad = gradient(mnfld_pnts, mnfld_pred)
 
             if (self.conf.get_string('network.loss.type') == "IGR"):
+                mnfld_sigma = batch["sigma"]
                 nonmnfld_pnts = self.sampler.get_points(mnfld_pnts.unsqueeze(0), mnfld_sigma.unsqueeze(0)).squeeze()
                 if (self.conf.get_string('train.encoding') == "FF"):
                     nonmnfld_pnts = torch.fft.fft(nonmnfld_pnts).real
-                    nonmnfld_pred = torch.fft.ifft(self.network(nonmnfld_pnts)).real
 
-                else:
-                    nonmnfld_pred = self.network(nonmnfld_pnts)
-                nonmnfld_grad = gradient(nonmnfld_pnts, nonmnfld_pred)
-                
+                # manifold and off manifold points in one forward pass
+                (mnfld_pred, mnfld_grad), (nonmnfld_pred, nonmnfld_grad) = forward_point_sets(self.forward_with_gradient, [mnfld_pnts, nonmnfld_pnts])
+
                 # manifold loss
                 mnfld_loss = (mnfld_pred.abs()).mean()
 
@@ -98,90 +88,76 @@ class ReconstructionRunner:
 
                 loss = mnfld_loss + self.grad_lambda * grad_loss
 
+                step_metrics = {"loss": loss, "manifold_loss": mnfld_loss, "eikonal_loss": grad_loss}
+
                 # normals loss
                 if self.with_normals:
                     normals = cur_data[:, -self.d_in:]
                     normals_loss = ((mnfld_grad - normals).abs()).norm(2, dim=1).mean()
                     loss = loss + self.normals_lambda * normals_loss
-                else:
-                    normals_loss = torch.zeros(1)
-                
-                loss_dict["loss"].append(loss.item())
-                loss_dict["manifold_loss"].append(mnfld_loss.item())
-                loss_dict["eikonal_loss"].append(grad_loss.item())
+                    step_metrics.update(loss=loss, normals_loss=normals_loss)
 
             elif (self.conf.get_string('network.loss.type') == "phase"):
-                u = mnfld_pred # [B, 1]
-
-                num_samples = self.conf.get_int('network.loss.sample_count')
-                sigma = self.conf.get_float('network.loss.sampling_sigma')
-                local_x = (mnfld_pnts.unsqueeze(dim=1).repeat(1, num_samples, 1) + (torch.randn((mnfld_pnts.shape[0], num_samples, mnfld_pnts.shape[1])) * sigma).cuda())
-                if (self.conf.get_string('train.encoding') == "FF"):
-                    local_x = torch.fft.fft(local_x).real
-                    local_u = torch.fft.ifft(self.network(local_x)).real.squeeze()
-
-                else:
-                    local_u = self.network(local_x).squeeze()
-
-                # reconstruction term 1 (L)
-                L = torch.mean(torch.abs(torch.mean(local_u, dim=-1)), dim=-1) # [1,]
-
-                # reconstruction term 2 
-                grad_u = mnfld_grad # [B, 3]
-                norm_grad_u = mnfld_grad.norm(2, dim=-1) # [B, 1]
-                epsilon = self.conf.get_float('network.loss.epsilon')
-                W = utils.potential(u) # [B, ]
-                integral_term = torch.mean((epsilon * torch.pow(norm_grad_u, 2)) + W) # [1, ]
-
-                reconstruction_loss = (self.conf.get_float('network.loss.lambda') * L) + integral_term
-
-                # regularization term
-                w = (-1) * np.sqrt(self.conf.get_float('network.loss.epsilon')) * torch.log(torch.abs(1 - torch.sum(u.squeeze()))) * torch.sign(u)
-                grad_w = gradient(mnfld_pnts, w)
-                norm_grad_w = grad_w.norm(2, dim=-1)
-
-                if self.with_normals:
-                    normals = cur_data[:, -self.d_in:]
-                    regularization_loss = torch.mean(torch.pow((normals - grad_w).norm(2, dim=-1), 2))
-                
-                else:
-                    regularization_loss = torch.mean(torch.pow(1 - norm_grad_w, 2))
-
-                loss = reconstruction_loss + (self.conf.get_float('network.loss.mu') * regularization_loss)
-
-                loss_dict["loss"].append(loss.item())
-                loss_dict["reconstruction_loss"].append(reconstruction_loss.item())
-                loss_dict["regularization_loss"].append(regularization_loss.item())
-
-            # back propagation
-
-            self.optimizer.zero_grad()
-
-            loss.backward()
-
-            self.optimizer.step()
-
-            if epoch % self.conf.get_int('train.status_frequency') == 0:
-                if (self.conf.get_string('network.loss.type') == "IGR"):
-                    print('Train Epoch: [{}/{} ({:.0f}%)]\tTrain Loss: {:.6f}\tManifold loss: {:.6f}'
-                        '\tGrad loss: {:.6f}\tNormals Loss: {:.6f}'.format(
-                        epoch, self.nepochs, 100. * epoch / self.nepochs,
-                        loss.item(), mnfld_loss.item(), grad_loss.item(), normals_loss.item()))
-                    loss
-                       
-                elif (self.conf.get_string('network.loss.type') == "phase"):
-                    print('Train Epoch: [{}/{} ({:.0f}%)]\tTrain Loss: {:.6f}\tReconstruction loss: {:.6f}'
-                                '\tRegularization loss: {:.6f}'.format(
-                                epoch, self.nepochs, 100. * epoch / self.nepochs,
-                                loss.item(), reconstruction_loss.item(), regularization_loss.item()))
-        
-        for key in loss_dict.keys():
-            plt.figure(figsize=(10, 8))
-            plt.plot(loss_dict[key], label=key)
-            plt.legend()
-            plt.tight_layout()
-            plt.savefig(self.cur_exp_dir + f"/{key}.png")
-            plt.close()
+                mnfld_pred, mnfld_grad = self.forward_with_gradient(mnfld_pnts)
+                normals = cur_data[:, -self.d_in:] if self.with_normals else None
+
+                # the local samples are backpropagated chunk by chunk inside the loss
+                loss, reconstruction_loss, regularization_loss = self.phase_loss(mnfld_pnts, mnfld_pred, mnfld_grad, normals)
+
+                step_metrics = {"loss": loss, "reconstruction_loss": reconstruction_loss, "regularization_loss": regularization_loss}
+
+            # back propagation, the loss is only scaled for fp16
+
+            self.scaler.scale(loss).backward()
+
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+
+            # running means stay on the device, the host only syncs every status_frequency epochs
+            record = self.metrics.update(epoch, dict(self.get_learning_rates(), passes=batches.passes), **step_metrics)
+            if not record is None:
+                print('Train Epoch: [{}/{} ({:.0f}%)]\tPasses: {:.2f}\t{}'.format(
+                    epoch, self.nepochs, 100. * epoch / self.nepochs, batches.passes, format_metrics(record, step_metrics.keys())))
+
+        self.metrics.flush()
+        plot_training_metrics(self.metrics.filename, self.cur_exp_dir)
+
+        self.close_writer()
+
+    @property
+    def local_sigma(self):
+        # distance to the k-th neighbour of every input point, cached outside the data folder
+        if self._local_sigma is None:
+            sigmas = get_local_sigma(self.data.detach().cpu().numpy(),
+                                     k=self.conf.get_int('network.sampler.properties.local_sigma_k', 50),
+                                     cache_dir=get_cache_dir())
+            self._local_sigma = utils.to_device(torch.from_numpy(sigmas))
+        return self._local_sigma
+
+    def forward_with_gradient(self, pnts):
+        # values and xyz gradients, the network returns both in one pass unless the FF encoding wraps it
+        if (self.conf.get_string('train.encoding') == "FF"):
+            pnts = pnts.detach().requires_grad_()
+            with utils.autocast():
+                pred = self.network(pnts)
+            pred = torch.fft.ifft(pred).real
+            return pred, gradient(pnts, pred)
+        with utils.autocast():
+            return self.network(pnts, with_gradient=True)
+
+    def evaluate(self, pnts):
+        # network values, through the FF encoding when configured
+        if (self.conf.get_string('train.encoding') == "FF"):
+            with utils.autocast():
+                pred = self.network(torch.fft.fft(pnts).real)
+            return torch.fft.ifft(pred).real
+        with utils.autocast():
+            return self.network(pnts)
+
+    def close_writer(self):
+        if not self.writer is None:
+            self.writer.close()
+        self.checkpoints.close()
 
 
     def plot_shapes(self, epoch, path=None, with_cuts=False):
@@ -196,13 +172,16 @@ class ReconstructionRunner:
             indices = torch.tensor(np.random.choice(self.data.shape[0], self.points_batch, False))
 
             pnts = self.data[indices, :3]
+            normals = self.data[indices, -self.d_in:] if self.with_normals else None
 
             plot_surface(with_points=True,
                          points=pnts,
+                         normals=normals,
                          decoder=self.network,
                          path=path,
                          epoch=epoch,
                          shapename=self.expname,
+                         writer=self.writer,
                          **self.conf.get_config('plot'))
 
             if with_cuts:
@@ -235,6 +214,8 @@ class ReconstructionRunner:
 
         self.num_of_gpus = torch.cuda.device_count()
 
+        self.device = utils.set_device_from_conf(self.conf)
+
         self.eval = kwargs['eval']
 
         # settings for loading an existing experiment
@@ -263,15 +244,8 @@ class ReconstructionRunner:
         # self.data = utils.load_point_cloud_by_file_extension(self.input_file)
         self.data = utils.load_point_cloud_files_from_folder(self.input_file)
 
-        sigma_set = []
-        ptree = cKDTree(self.data)
-
-        for p in np.array_split(self.data, 100, axis=0):
-            d = ptree.query(p, 50 + 1)
-            sigma_set.append(d[0][:, -1])
-
-        sigmas = np.concatenate(sigma_set)
-        self.local_sigma = torch.from_numpy(sigmas).float().cuda()
+        # the local sigmas are only computed once the sampler needs them
+        self._local_sigma = None
 
         self.expdir = utils.concat_home_dir(os.path.join(self.home_dir, self.exps_folder_name, self.expname))
         utils.mkdir_ifnotexists(self.expdir)
@@ -284,28 +258,27 @@ class ReconstructionRunner:
         self.cur_exp_dir = os.path.join(self.expdir, self.timestamp)
         utils.mkdir_ifnotexists(self.cur_exp_dir)
 
+        # training losses, appended as running means every status_frequency epochs
+        self.metrics = MetricLogger(os.path.join(self.cur_exp_dir, 'train_metrics.{0}'.format(self.conf.get_string('train.metrics_format', 'jsonl'))),
+                                    self.conf.get_int('train.status_frequency'))
+
         self.plots_dir = os.path.join(self.cur_exp_dir, 'plots')
         utils.mkdir_ifnotexists(self.plots_dir)
 
         self.checkpoints_path = os.path.join(self.cur_exp_dir, 'checkpoints')
         utils.mkdir_ifnotexists(self.checkpoints_path)
 
-        self.checkpoints_path = os.path.join(self.cur_exp_dir, 'checkpoints')
-        utils.mkdir_ifnotexists(self.checkpoints_path)
-
-        self.model_params_subdir = "ModelParameters"
-        self.optimizer_params_subdir = "OptimizerParameters"
-
-        utils.mkdir_ifnotexists(os.path.join(self.checkpoints_path, self.model_params_subdir))
-        utils.mkdir_ifnotexists(os.path.join(self.checkpoints_path, self.optimizer_params_subdir))
+        # checkpoints are written in the background, one file per epoch
+        self.checkpoints = CheckpointManager(self.checkpoints_path,
+                                             keep_last=self.conf.get_int('train.checkpoint_keep_last', 0),
+                                             keep_every=self.conf.get_int('train.checkpoint_keep_every', 0))
 
         self.nepochs = kwargs['nepochs']
 
         self.points_batch = kwargs['points_batch']
 
         self.global_sigma = self.conf.get_float('network.sampler.properties.global_sigma')
-        self.sampler = Sampler.get_sampler(self.conf.get_string('network.sampler.sampler_type'))(self.global_sigma,
-                                                                                                 self.local_sigma)
+        self.sampler = Sampler.get_sampler(self.conf.get_string('network.sampler.sampler_type'))(self.global_sigma)
         self.grad_lambda = self.conf.get_float('network.loss.lambda')
         self.normals_lambda = self.conf.get_float('network.loss.normals_lambda')
 
@@ -318,8 +291,17 @@ class ReconstructionRunner:
                                                                                     **self.conf.get_config(
                                                                                         'network.inputs'))
 
-        if torch.cuda.is_available():
-            self.network.cuda()
+        self.network.to(self.device)
+
+        # mixed precision (train.precision), the network runs under autocast and the losses in float32
+        self.scaler = utils.get_grad_scaler()
+
+        if (self.conf.get_string('network.loss.type') == "phase"):
+            self.phase_loss = PhaseLoss.from_conf(self.evaluate, self.network, self.conf.get_config('network.loss'), self.scaler)
+            print('phase loss local samples in chunks of {0} points'.format(self.phase_loss.chunk_size))
+
+        # plots and meshes are written in the background, 0 workers writes them on the training thread
+        self.writer = get_artifact_writer(self.conf.get_int('train.export_workers', 0))
 
         self.lr_schedules = self.get_learning_rate_schedules(self.conf.get_list('train.learning_rate_schedule'))
         self.weight_decay = self.conf.get_float('train.weight_decay')
@@ -340,14 +322,10 @@ class ReconstructionRunner:
         if is_continue:
             old_checkpnts_dir = os.path.join(self.expdir, timestamp, 'checkpoints')
 
-            saved_model_state = torch.load(
-                os.path.join(old_checkpnts_dir, 'ModelParameters', str(kwargs['checkpoint']) + ".pth"))
-            self.network.load_state_dict(saved_model_state["model_state_dict"])
-
-            data = torch.load(
-                os.path.join(old_checkpnts_dir, 'OptimizerParameters', str(kwargs['checkpoint']) + ".pth"))
+            data = load_checkpoint(old_checkpnts_dir, kwargs['checkpoint'], map_location=self.device)
+            self.network.load_state_dict(data["model_state_dict"])
             self.optimizer.load_state_dict(data["optimizer_state_dict"])
-            self.startepoch = saved_model_state['epoch']
+            self.startepoch = data['epoch']
 
     def get_learning_rate_schedules(self, schedule_specs):
 
@@ -376,23 +354,15 @@ class ReconstructionRunner:
     def adjust_learning_rate(self, epoch):
         for i, param_group in enumerate(self.optimizer.param_groups):
             param_group["lr"] = self.lr_schedules[i].get_learning_rate(epoch)
-            print(f"Epoch {epoch}: lr = {param_group['lr']}")
 
-    def save_checkpoints(self, epoch):
+    def get_learning_rates(self):
+        return {"lr_{0}".format(i): param_group["lr"] for i, param_group in enumerate(self.optimizer.param_groups)}
 
-        torch.save(
-            {"epoch": epoch, "model_state_dict": self.network.state_dict()},
-            os.path.join(self.checkpoints_path, self.model_params_subdir, str(epoch) + ".pth"))
-        torch.save(
-            {"epoch": epoch, "model_state_dict": self.network.state_dict()},
-            os.path.join(self.checkpoints_path, self.model_params_subdir, "latest.pth"))
+    def save_checkpoints(self, epoch):
 
-        torch.save(
-            {"epoch": epoch, "optimizer_state_dict": self.optimizer.state_dict()},
-            os.path.join(self.checkpoints_path, self.optimizer_params_subdir, str(epoch) + ".pth"))
-        torch.save(
-            {"epoch": epoch, "optimizer_state_dict": self.optimizer.state_dict()},
-            os.path.join(self.checkpoints_path, self.optimizer_params_subdir, "latest.pth"))
+        self.checkpoints.save(epoch,
+                              model_state_dict=self.network.state_dict(),
+                              optimizer_state_dict=self.optimizer.state_dict())
 
 
 if __name__ == '__main__':
@@ -413,7 +383,8 @@ if __name__ == '__main__':
     if args.gpu == "auto":
         deviceIDs = GPUtil.getAvailable(order='memory', limit=1, maxLoad=0.5, maxMemory=0.5, includeNan=False, excludeID=[],
                                     excludeUUID=[])
-        gpu = deviceIDs[0]
+        # no visible gpu, the device then falls back to the cpu
+        gpu = deviceIDs[0] if len(deviceIDs) > 0 else 'ignore'
     else:
         gpu = args.gpu
 
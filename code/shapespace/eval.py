@@ -8,11 +8,13 @@ import json
 import utils.general as utils
 import torch
 from pyhocon import ConfigFactory
+from utils.checkpoints import load_checkpoint
 import utils.plots as plt
-from shapespace.latent_optimizer import optimize_latent
+from model.network import add_latent
+from shapespace.latent_optimizer import optimize_latents
 
 
-def evaluate(network, experiment_directory, conf, checkpoint, split_file, epoch, resolution, uniform_grid):
+def evaluate(network, experiment_directory, conf, checkpoint, split_file, epoch, resolution, uniform_grid, batch_size=1, tolerance=0.0, patience=50):
 
     my_path = os.path.join(experiment_directory, 'evaluation', str(checkpoint))
 
@@ -27,45 +29,50 @@ def evaluate(network, experiment_directory, conf, checkpoint, split_file, epoch,
     total_files = len(ds)
     print("total files : {0}".format(total_files))
     counter = 0
-    dataloader = torch.utils.data.DataLoader(ds, batch_size=1, shuffle=True, num_workers=1, drop_last=False, pin_memory=True)
+    dataloader = torch.utils.data.DataLoader(ds, batch_size=batch_size, shuffle=True, num_workers=1, drop_last=False, pin_memory=utils.get_device().type == 'cuda')
 
     for (input_pc, normals, index) in dataloader:
 
-        input_pc = input_pc.cuda().squeeze()
-        normals = normals.cuda().squeeze()
+        input_pc = utils.to_device(input_pc)
+        normals = utils.to_device(normals)
 
         print(counter)
-        counter = counter + 1
+        counter = counter + input_pc.shape[0]
 
         network.train()
 
-        latent = optimize_latent(input_pc, normals, conf, 800, network, lr=5e-3)
+        # the latents of all the shapes of the batch are optimized together
+        latents = optimize_latents(input_pc, normals, conf, 800, network, lr=5e-3, tolerance=tolerance, patience=patience)
 
-        all_latent = latent.repeat(input_pc.shape[0], 1)
+        for k in range(input_pc.shape[0]):
 
-        points = torch.cat([all_latent,input_pc], dim=-1)
+            latent = latents[k]
 
-        shapename = str.join('_', ds.get_info(index))
+            points = add_latent(input_pc[k:k + 1], latents[k:k + 1])
 
-        with torch.no_grad():
+            shapename = str.join('_', ds.get_info(int(index[k])))
 
-            network.eval()
+            with torch.no_grad():
 
-            plt.plot_surface(with_points=True,
-                             points=points,
-                             decoder=network,
-                             latent=latent,
-                             path=my_path,
-                             epoch=epoch,
-                             shapename=shapename,
-                             resolution=resolution,
-                             mc_value=0,
-                             is_uniform_grid=uniform_grid,
-                             verbose=True,
-                             save_html=True,
-                             save_ply=True,
-                             overwrite=True,
-                             connected=True)
+                network.eval()
+
+                plt.plot_surface(with_points=True,
+                                 points=points,
+                                 normals=normals[k],
+                                 decoder=network,
+                                 latent=latent,
+                                 path=my_path,
+                                 epoch=epoch,
+                                 shapename=shapename,
+                                 resolution=resolution,
+                                 mc_value=0,
+                                 is_uniform_grid=uniform_grid,
+                                 verbose=True,
+                                 save_html=True,
+                                 save_ply=True,
+                                 overwrite=True,
+                                 connected=True,
+                                 extraction=conf.get_string('plot.extraction', 'dense'))
 
 
 if __name__ == '__main__':
@@ -143,6 +150,31 @@ if __name__ == '__main__':
         default=False
     )
 
+    arg_parser.add_argument(
+        "--batch-size",
+        "-b",
+        dest="batch_size",
+        type=int,
+        help='number of shapes whose latents are optimized together',
+        default=8
+    )
+
+    arg_parser.add_argument(
+        "--tolerance",
+        dest="tolerance",
+        type=float,
+        help='relative loss improvement below which a shape stops its latent optimization (e.g. 1e-3), 0 runs all iterations',
+        default=0.0
+    )
+
+    arg_parser.add_argument(
+        "--patience",
+        dest="patience",
+        type=int,
+        help='iterations without improvement before a shape stops its latent optimization',
+        default=50
+    )
+
     print('evaluating')
 
     args = arg_parser.parse_args()
@@ -154,6 +186,7 @@ if __name__ == '__main__':
         os.environ["CUDA_VISIBLE_DEVICES"] = '{0}'.format(args.gpu_num)
 
     conf = ConfigFactory.parse_file(os.path.join(code_path, 'shapespace', args.conf))
+    utils.set_device_from_conf(conf)
 
     experiment_directory = os.path.join(exps_path, args.exp_name)
 
@@ -164,7 +197,7 @@ if __name__ == '__main__':
         timestamp = args.timestamp
 
     experiment_directory = os.path.join(experiment_directory, timestamp)
-    saved_model_state = torch.load(os.path.join(experiment_directory, 'checkpoints', 'ModelParameters', args.epoch + ".pth"))
+    saved_model_state = load_checkpoint(os.path.join(experiment_directory, 'checkpoints'), args.epoch, map_location=utils.get_device())
     saved_model_epoch = saved_model_state["epoch"]
     with_normals = conf.get_float('network.loss.normals_lambda') > 0
     network = utils.get_class(conf.get_string('train.network_class'))(d_in=conf.get_int('train.latent_size')+conf.get_int('train.d_in'), **conf.get_config('network.inputs'))
@@ -174,14 +207,17 @@ if __name__ == '__main__':
     split_file = os.path.join(code_path, 'splits', args.split)
 
     evaluate(
-        network=network.cuda(),
+        network=utils.to_device(network),
         experiment_directory=experiment_directory,
         conf=conf,
         checkpoint=saved_model_epoch,
         split_file=split_file,
         epoch=saved_model_epoch,
         resolution=args.resolution,
-        uniform_grid=args.uniform_grid
+        uniform_grid=args.uniform_grid,
+        batch_size=args.batch_size,
+        tolerance=args.tolerance,
+        patience=args.patience
     )
 
 
@@ -5,15 +5,18 @@ sys.path.append(project_dir)
 os.chdir(project_dir)
 import argparse
 import json
+import multiprocessing
 import utils.general as utils
 import torch
 import numpy as np
 import utils.plots as plt
+import utils.meshing as meshing
 from pyhocon import ConfigFactory
-from shapespace.latent_optimizer import optimize_latent
+from utils.checkpoints import load_checkpoint
+from shapespace.latent_optimizer import optimize_latents
 
 
-def interpolate(network, interval, experiment_directory, checkpoint, split_file, epoch, resolution, uniform_grid):
+def interpolate(network, interval, experiment_directory, checkpoint, split_file, epoch, resolution, uniform_grid, batch_size=8, workers=4, extraction='dense'):
 
     with open(split_file, "r") as f:
         split = json.load(f)
@@ -23,7 +26,7 @@ def interpolate(network, interval, experiment_directory, checkpoint, split_file,
     points_1, normals_1, index_1 = ds[0]
     points_2, normals_2, index_2 = ds[1]
 
-    pnts = torch.cat([points_1, points_2], dim=0).cuda()
+    pnts = utils.to_device(torch.cat([points_1, points_2], dim=0))
 
     name_1 = str.join('_', ds.get_info(0))
     name_2 = str.join('_', ds.get_info(0))
@@ -36,34 +39,51 @@ def interpolate(network, interval, experiment_directory, checkpoint, split_file,
 
     my_path = os.path.join(experiment_directory, 'interpolate', str(checkpoint), name)
 
-    latent_1 = optimize_latent(points_1.cuda(), normals_1.cuda(), conf, 800, network, 5e-3)
-    latent_2 = optimize_latent(points_2.cuda(), normals_2.cuda(), conf, 800, network, 5e-3)
+    latents = optimize_latents(utils.to_device(torch.stack([points_1, points_2])), utils.to_device(torch.stack([normals_1, normals_2])), conf, 800, network, 5e-3)
+    latent_1, latent_2 = latents[0:1], latents[1:2]
 
-    pnts = torch.cat([latent_1.repeat(pnts.shape[0], 1), pnts], dim=-1)
+    if (uniform_grid):
+        grid = plt.get_grid_uniform(resolution)
+    else:
+        grid = plt.get_grid(pnts, resolution)
+
+    alphas = np.linspace(0, 1, interval)
 
-    with torch.no_grad():
+    # decode batches of interpolated latents, meshing and export of every step run in the pool and
+    # stream back one at a time, with at most two batches in flight
+    with multiprocessing.Pool(workers) as pool, torch.no_grad():
         network.eval()
 
-        for alpha in np.linspace(0,1, interval):
+        pending = None
+        for batch in np.array_split(alphas, int(np.ceil(len(alphas) / batch_size))):
+
+            alpha = torch.tensor(batch, dtype=torch.float, device=latent_1.device).unsqueeze(1)
+            latent = (latent_1 * (1 - alpha)) + (latent_2 * alpha)
+
+            if (extraction == 'dense'):
+                # one batched pass over the shared grid for all the latents of the batch
+                surfaces = [{"volume": z, "spacing": grid.spacing, "origin": grid.origin}
+                            for z in meshing.get_volumes(network, latent, grid, verbose=True)]
+            else:
+                surfaces = [plt.get_surface(pnts, network, latent[k:k + 1], resolution, 0, uniform_grid, True, extraction)
+                            for k in range(latent.shape[0])]
+
+            exports = pool.imap(export_step, [(surface, '{0}/igr_{1}_{2}'.format(my_path, epoch, str(a))) for a, surface in zip(batch, surfaces)])
+            del surfaces
+
+            if not pending is None:
+                for filename in pending:
+                    print(filename)
+            pending = exports
 
-            latent = (latent_1 * (1-alpha)) + (latent_2 * alpha)
+        if not pending is None:
+            for filename in pending:
+                print(filename)
 
-            plt.plot_surface(with_points=False,
-                             points=pnts,
-                             decoder=network,
-                             latent=latent,
-                             path=my_path,
-                             epoch=epoch,
-                             shapename=str(alpha),
-                             resolution=resolution,
-                             mc_value=0,
-                             is_uniform_grid=uniform_grid,
-                             verbose=True,
-                             save_html=False,
-                             save_ply=True,
-                             overwrite=True,
-                             connected=True)
 
+def export_step(step):
+    surface, filename = step
+    return meshing.export_surface_mesh(surface, 0, filename, True)
 
 if __name__ == '__main__':
 
@@ -147,6 +167,24 @@ if __name__ == '__main__':
         default=False
     )
 
+    arg_parser.add_argument(
+        "--batch-size",
+        "-b",
+        dest="batch_size",
+        type=int,
+        help='number of interpolated latents decoded together',
+        default=8
+    )
+
+    arg_parser.add_argument(
+        "--workers",
+        "-w",
+        dest="workers",
+        type=int,
+        help='number of processes meshing and exporting the decoded volumes',
+        default=4
+    )
+
     cur_dir = os.path.abspath('dfaust')
 
     args = arg_parser.parse_args()
@@ -158,6 +196,7 @@ if __name__ == '__main__':
         os.environ["CUDA_VISIBLE_DEVICES"] = '{0}'.format(args.gpu_num)
 
     conf = ConfigFactory.parse_file(os.path.join(code_path, 'shapespace', args.conf))
+    utils.set_device_from_conf(conf)
 
     experiment_directory = os.path.join(exps_path, args.exp_name)
 
@@ -168,7 +207,7 @@ if __name__ == '__main__':
         timestamp = args.timestamp
 
     experiment_directory = os.path.join(experiment_directory, timestamp)
-    saved_model_state = torch.load(os.path.join(experiment_directory, 'checkpoints', 'ModelParameters', args.epoch + ".pth"))
+    saved_model_state = load_checkpoint(os.path.join(experiment_directory, 'checkpoints'), args.epoch, map_location=utils.get_device())
     saved_model_epoch = saved_model_state["epoch"]
     with_normals = conf.get_float('network.loss.normals_lambda') > 0
     network = utils.get_class(conf.get_string('train.network_class'))(d_in=conf.get_int('train.latent_size')+conf.get_int('train.d_in'), **conf.get_config('network.inputs'))
@@ -177,12 +216,15 @@ if __name__ == '__main__':
     split_file = os.path.join(code_path, 'splits', args.split)
 
     interpolate(
-        network=network.cuda(),
+        network=utils.to_device(network),
         interval=args.interval,
         experiment_directory=experiment_directory,
         checkpoint=saved_model_epoch,
         split_file=split_file,
         epoch=saved_model_epoch,
         resolution=args.resolution,
-        uniform_grid=args.uniform_grid
+        uniform_grid=args.uniform_grid,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        extraction=conf.get_string('plot.extraction', 'dense')
     )
@@ -4,7 +4,8 @@ project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)
 sys.path.append(project_dir)
 os.chdir(project_dir)
 import torch
-from model.network import gradient
+import utils.general as utils
+from model.network import get_latent_decoder, forward_point_sets
 from model.sample import Sampler
 
 
@@ -17,6 +18,20 @@ def adjust_learning_rate(initial_lr, optimizer, iter):
 
 def optimize_latent(points, normals, conf, num_of_iterations, network, lr=1.0e-2):
 
+    return optimize_latents(points.unsqueeze(0), normals.unsqueeze(0), conf, num_of_iterations, network, lr)
+
+
+def optimize_latents(points, normals, conf, num_of_iterations, network, lr=1.0e-2, tolerance=0.0, patience=50, verbose_frequency=100):
+    """
+    Jointly optimize one latent per shape, points and normals are (K, N, 3), with one network pass
+    per iteration for all the shapes still being optimized.
+    Each latent only sees the loss of its own shape, so this matches K separate optimize_latent runs.
+
+    With tolerance > 0, a shape whose loss has not improved by that fraction of its best loss for
+    patience iterations is converged and leaves the batch, the others continue unchanged.
+    Returns the (K, latent_size) latents.
+    """
+
     latent_size = conf.get_int('train.latent_size')
     global_sigma = conf.get_float('network.sampler.properties.global_sigma')
     local_sigma = conf.get_float('network.sampler.properties.local_sigma')
@@ -28,47 +43,83 @@ def optimize_latent(points, normals, conf, num_of_iterations, network, lr=1.0e-2
 
     grad_lambda = conf.get_float('network.loss.lambda')
 
-    num_of_points, dim = points.shape
+    num_of_shapes = points.shape[0]
 
-    latent = torch.ones(latent_size).normal_(0, 1 / latent_size).cuda()
-    # latent = torch.zeros(latent_size).cuda()
+    latent = torch.ones(num_of_shapes, latent_size, device=points.device).normal_(0, 1 / latent_size)
+    # latent = torch.zeros(num_of_shapes, latent_size, device=points.device)
 
     latent.requires_grad = True
 
     optimizer = torch.optim.Adam([latent], lr=lr)
+    scaler = utils.get_grad_scaler()
+
+    # the shapes still in the batch, their best loss and the iterations since it improved
+    latents = torch.zeros(num_of_shapes, latent_size, device=points.device)
+    active = torch.arange(num_of_shapes, device=points.device)
+    best_loss = torch.full((num_of_shapes,), float('inf'), device=points.device)
+    stale = torch.zeros(num_of_shapes, dtype=torch.long, device=points.device)
 
     for i in range(num_of_iterations):
 
-        sample = sampler.get_points(points.unsqueeze(0)).squeeze()
+        nonsurface_pnts = sampler.get_points(points)
+        surface_pnts = points.detach()
 
-        latent_all = latent.expand(num_of_points, -1)
-        surface_pnts = torch.cat([latent_all, points], dim=1)
+        decoder = get_latent_decoder(network, latent, with_gradient=True)
 
-        sample_latent_all = latent.expand(sample.shape[0], -1)
-        nonsurface_pnts = torch.cat([sample_latent_all, sample], dim=1)
+        # surface and off surface points of each shape in one forward pass
+        with utils.autocast():
+            (surface_pred, surface_grad), (nonsurface_pred, nonsurface_grad) = forward_point_sets(decoder, [surface_pnts, nonsurface_pnts], dim=1)
 
-        surface_pnts.requires_grad_()
-        nonsurface_pnts.requires_grad_()
+        # per shape losses, summed so that every latent gets the gradient of its own shape only
+        surface_loss = torch.abs(surface_pred).mean(dim=(1, 2))
+        grad_loss = torch.mean((nonsurface_grad.norm(2, dim=-1) - 1).pow(2), dim=1)
+        normals_loss = ((surface_grad - normals).abs()).norm(2, dim=-1).mean(dim=1)
+        latent_loss = latent.abs().mean(dim=1)
+        shape_loss = surface_loss + latent_lambda * latent_loss + normals_lambda * normals_loss + grad_lambda * grad_loss
+        loss = shape_loss.sum()
 
-        surface_pred = network(surface_pnts)
-        nonsurface_pred = network(nonsurface_pnts)
+        adjust_learning_rate(lr, optimizer, i)
 
-        surface_grad = gradient(surface_pnts, surface_pred)
-        nonsurface_grad = gradient(nonsurface_pnts, nonsurface_pred)
+        optimizer.zero_grad()
 
-        surface_loss = torch.abs(surface_pred).mean()
-        grad_loss = torch.mean((nonsurface_grad.norm(2, dim=-1) - 1).pow(2))
-        normals_loss = ((surface_grad - normals).abs()).norm(2, dim=1).mean()
-        latent_loss = latent.abs().mean()
-        loss = surface_loss + latent_lambda * latent_loss + normals_lambda * normals_loss + grad_lambda * grad_loss
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
-        adjust_learning_rate(lr, optimizer, i)
+        if verbose_frequency > 0 and i % verbose_frequency == 0:
+            print('latent loss iter {0}:{1} ({2} shapes)'.format(i, loss.item(), active.shape[0]))
 
-        optimizer.zero_grad()
+        if tolerance > 0:
+            shape_loss = shape_loss.detach()
+            improved = shape_loss < best_loss * (1 - tolerance)
+            best_loss = torch.where(improved, shape_loss, best_loss)
+            stale = torch.where(improved, torch.zeros_like(stale), stale + 1)
+
+            converged = stale >= patience
+            if converged.any():
+                latents[active[converged]] = latent.detach()[converged]
+
+                keep = ~converged
+                if not keep.any():
+                    print('latents converged after {0} iterations'.format(i + 1))
+                    return latents
+
+                active, best_loss, stale = active[keep], best_loss[keep], stale[keep]
+                points, normals = points[keep], normals[keep]
+                latent, optimizer = drop_latents(latent, optimizer, keep)
+
+    latents[active] = latent.detach()
+    return latents
 
-        loss.backward()
-        optimizer.step()
 
-        print('latent loss iter {0}:{1}'.format(i, loss.item()))
+def drop_latents(latent, optimizer, keep):
+    # the kept rows of the latent with their Adam moments, Adam being elementwise the kept rows continue as before
+    kept_latent = latent.detach()[keep].requires_grad_()
+    kept_optimizer = torch.optim.Adam([kept_latent], lr=optimizer.param_groups[0]["lr"])
 
-    return latent.unsqueeze(0)
+    state = optimizer.state[latent]
+    if len(state) > 0:
+        kept_optimizer.state[kept_latent] = {"step": state["step"],
+                                             "exp_avg": state["exp_avg"][keep],
+                                             "exp_avg_sq": state["exp_avg_sq"][keep]}
+    return kept_latent, kept_optimizer
@@ -11,8 +11,11 @@ import json
 import torch
 import utils.general as utils
 from model.sample import Sampler
-from model.network import gradient
-from utils.plots import plot_surface, plot_cuts
+from model.network import forward_point_sets, add_latent
+from utils.plots import plot_surface, plot_cuts, plot_training_metrics
+from utils.metrics import MetricLogger, format_metrics
+from utils.artifacts import get_artifact_writer
+from utils.checkpoints import CheckpointManager, load_checkpoint
 
 
 class ShapeSpaceRunner:
@@ -21,6 +24,8 @@ class ShapeSpaceRunner:
 
         print("running")
 
+        self.step = self.startepoch * len(self.train_dataloader)
+
         for epoch in range(self.startepoch, self.nepochs + 1):
 
             if epoch % self.conf.get_int('train.checkpoint_frequency') == 0:
@@ -35,26 +40,21 @@ class ShapeSpaceRunner:
             before_epoch = time()
             for data_index,(mnfld_pnts, normals, indices) in enumerate(self.train_dataloader):
 
-                mnfld_pnts = mnfld_pnts.cuda()
+                mnfld_pnts = mnfld_pnts.to(self.device, non_blocking=True)
 
                 if self.with_normals:
-                    normals = normals.cuda()
+                    normals = normals.to(self.device, non_blocking=True)
 
                 nonmnfld_pnts = self.sampler.get_points(mnfld_pnts)
 
-                mnfld_pnts = self.add_latent(mnfld_pnts, indices)
-                nonmnfld_pnts = self.add_latent(nonmnfld_pnts, indices)
-
-                # forward pass
-
-                mnfld_pnts.requires_grad_()
-                nonmnfld_pnts.requires_grad_()
+                # manifold and off manifold points of every shape in one forward pass, the network returns the
+                # xyz gradients, the latents enter through their per shape projections
 
-                mnfld_pred = self.network(mnfld_pnts)
-                nonmnfld_pred = self.network(nonmnfld_pnts)
+                latents = self.lat_vecs(indices.to(self.device))
 
-                mnfld_grad = gradient(mnfld_pnts, mnfld_pred)
-                nonmnfld_grad = gradient(nonmnfld_pnts, nonmnfld_pred)
+                with utils.autocast():
+                    (mnfld_pred, mnfld_grad), (nonmnfld_pred, nonmnfld_grad) = forward_point_sets(
+                        lambda pnts: self.network(pnts, with_gradient=True, latent=latents), [mnfld_pnts, nonmnfld_pnts], dim=1)
 
                 # manifold loss
 
@@ -66,38 +66,53 @@ class ShapeSpaceRunner:
 
                 loss = mnfld_loss + self.grad_lambda * grad_loss
 
+                step_metrics = {"manifold_loss": mnfld_loss, "eikonal_loss": grad_loss}
+
                 # normals loss
                 if self.with_normals:
-                    normals = normals.view(-1, 3)
-                    normals_loss = ((mnfld_grad - normals).abs()).norm(2, dim=1).mean()
+                    normals_loss = ((mnfld_grad - normals).abs()).norm(2, dim=-1).mean()
                     loss = loss + self.normals_lambda * normals_loss
-                else:
-                    normals_loss = torch.zeros(1)
+                    step_metrics["normals_loss"] = normals_loss
 
                 # latent loss
 
-                latent_loss = self.latent_size_reg(indices.cuda())
+                latent_loss = self.latent_size_reg(indices.to(self.device))
 
                 loss = loss + self.latent_lambda * latent_loss
 
                 # back propagation
 
                 self.optimizer.zero_grad()
+                self.latent_optimizer.zero_grad()
 
-                loss.backward()
+                self.scaler.scale(loss).backward()
 
-                self.optimizer.step()
+                self.scaler.step(self.optimizer)
+                self.scaler.step(self.latent_optimizer)
+                self.scaler.update()
 
-                # print status
-                if data_index % self.conf.get_int('train.status_frequency') == 0:
-                    print('Train Epoch: {} [{}/{} ({:.0f}%)]\tTrain Loss: {:.6f}\tManifold loss: {:.6f}'
-                          '\tGrad loss: {:.6f}\tLatent loss: {:.6f}\tNormals Loss: {:.6f}'.format(
+                # running means stay on the device, the host only syncs every status_frequency steps
+                step_metrics.update(loss=loss, latent_loss=latent_loss)
+                record = self.metrics.update(self.step, dict(self.get_learning_rates(), epoch=epoch), **step_metrics)
+                self.step += 1
+                if not record is None:
+                    print('Train Epoch: {} [{}/{} ({:.0f}%)]\t{}'.format(
                         epoch, data_index * self.batch_size, len(self.ds), 100. * data_index / len(self.train_dataloader),
-                               loss.item(), mnfld_loss.item(), grad_loss.item(), latent_loss.item(), normals_loss.item()))
+                        format_metrics(record, step_metrics.keys())))
 
             after_epoch = time()
             print('epoch time {0}'.format(str(after_epoch-before_epoch)))
 
+            if not self.ds.cache is None:
+                print('dataset cache: {hits} hits, {misses} misses, {evictions} evictions, hit rate {hit_rate:.3f}, {used:.1f} MB'.format(**self.ds.cache.stats()))
+
+        self.metrics.flush()
+        plot_training_metrics(self.metrics.filename, os.path.join(self.expdir, self.cur_exp_dir))
+
+        if not self.writer is None:
+            self.writer.close()
+        self.checkpoints.close()
+
     def plot_validation_shapes(self, epoch, with_cuts=False):
         # plot network validation shapes
         with torch.no_grad():
@@ -106,20 +121,23 @@ class ShapeSpaceRunner:
 
             self.network.eval()
             pnts, normals, idx = next(iter(self.eval_dataloader))
-            pnts = utils.to_cuda(pnts)
+            pnts = pnts.to(self.device)
+            normals = normals.squeeze(0) if self.with_normals else None
 
             pnts = self.add_latent(pnts, idx)
-            latent = self.lat_vecs[idx[0]]
+            latent = self.lat_vecs.weight[idx[0]]
 
             shapename = str.join('_', self.ds.get_info(idx))
 
             plot_surface(with_points=True,
                          points=pnts,
+                         normals=normals,
                          decoder=self.network,
                          latent=latent,
                          path=self.plots_dir,
                          epoch=epoch,
                          shapename=shapename,
+                         writer=self.writer,
                          **self.conf.get_config('plot'))
 
             if with_cuts:
@@ -153,6 +171,8 @@ class ShapeSpaceRunner:
 
         self.num_of_gpus = torch.cuda.device_count()
 
+        self.device = utils.set_device_from_conf(self.conf)
+
         # settings for loading an existing experiment
 
         if kwargs['is_continue'] and kwargs['timestamp'] == 'latest':
@@ -186,31 +206,29 @@ class ShapeSpaceRunner:
         self.cur_exp_dir = self.timestamp
         utils.mkdir_ifnotexists(os.path.join(self.expdir, self.cur_exp_dir))
 
+        # training losses, appended as running means every status_frequency steps
+        self.metrics = MetricLogger(os.path.join(self.expdir, self.cur_exp_dir, 'train_metrics.{0}'.format(self.conf.get_string('train.metrics_format', 'jsonl'))),
+                                    self.conf.get_int('train.status_frequency'))
+
         self.plots_dir = os.path.join(self.expdir, self.cur_exp_dir, 'plots')
         utils.mkdir_ifnotexists(self.plots_dir)
 
         self.checkpoints_path = os.path.join(self.expdir, self.cur_exp_dir, 'checkpoints')
         utils.mkdir_ifnotexists(self.checkpoints_path)
 
-        self.checkpoints_path = os.path.join(self.expdir, self.cur_exp_dir, 'checkpoints')
-        utils.mkdir_ifnotexists(self.checkpoints_path)
-
-        self.model_params_subdir = "ModelParameters"
-        self.optimizer_params_subdir = "OptimizerParameters"
-        self.latent_codes_subdir = "LatentCodes"
-
-        utils.mkdir_ifnotexists(os.path.join(self.checkpoints_path,self.model_params_subdir))
-        utils.mkdir_ifnotexists(os.path.join(self.checkpoints_path, self.optimizer_params_subdir))
-        utils.mkdir_ifnotexists(os.path.join(self.checkpoints_path, self.latent_codes_subdir))
+        # checkpoints are written in the background, one file per epoch
+        self.checkpoints = CheckpointManager(self.checkpoints_path,
+                                             keep_last=self.conf.get_int('train.checkpoint_keep_last', 0),
+                                             keep_every=self.conf.get_int('train.checkpoint_keep_every', 0))
 
         self.nepochs = kwargs['nepochs']
 
         self.batch_size = kwargs['batch_size']
 
-        if self.num_of_gpus > 0:
+        if self.device.type == 'cuda' and self.num_of_gpus > 0:
             self.batch_size *= self.num_of_gpus
 
-        self.parallel = self.num_of_gpus > 1
+        self.parallel = self.device.type == 'cuda' and self.num_of_gpus > 1
 
         self.global_sigma = self.conf.get_float('network.sampler.properties.global_sigma')
         self.local_sigma = self.conf.get_float('network.sampler.properties.local_sigma')
@@ -238,6 +256,7 @@ class ShapeSpaceRunner:
                                                                          dataset_path=self.conf.get_string(
                                                                              'train.dataset_path'),
                                                                          points_batch=kwargs['points_batch'],
+                                                                         cache_size=self.conf.get_int('train.dataset_cache', 0)
                                                                          )
 
         self.num_scenes = len(self.ds)
@@ -245,7 +264,7 @@ class ShapeSpaceRunner:
         self.train_dataloader = torch.utils.data.DataLoader(self.ds,
                                                       batch_size=self.batch_size,
                                                       shuffle=True,
-                                                      num_workers=kwargs['threads'], drop_last=True, pin_memory=True)
+                                                      num_workers=kwargs['threads'], drop_last=True, pin_memory=self.device.type == 'cuda')
         self.eval_dataloader = torch.utils.data.DataLoader(self.ds,
                                                            batch_size=1,
                                                            shuffle=True,
@@ -256,8 +275,10 @@ class ShapeSpaceRunner:
         if self.parallel:
             self.network = torch.nn.DataParallel(self.network)
 
-        if torch.cuda.is_available():
-            self.network.cuda()
+        self.network.to(self.device)
+
+        # plots and meshes are written in the background, 0 workers writes them on the training thread
+        self.writer = get_artifact_writer(self.conf.get_int('train.export_workers', 0))
 
         self.lr_schedules = self.get_learning_rate_schedules(self.conf.get_list('train.learning_rate_schedule'))
         self.weight_decay = self.conf.get_float('train.weight_decay')
@@ -266,8 +287,12 @@ class ShapeSpaceRunner:
 
         self.startepoch = 0
 
-        self.lat_vecs = torch.zeros(self.num_scenes, self.latent_size).cuda()
-        self.lat_vecs.requires_grad_()
+        # one latent code per shape, a step only produces gradients for the rows of its batch
+        self.lat_vecs = torch.nn.Embedding(self.num_scenes, self.latent_size, sparse=True).to(self.device)
+        torch.nn.init.zeros_(self.lat_vecs.weight)
+
+        # mixed precision (train.precision), the network runs under autocast and the losses in float32
+        self.scaler = utils.get_grad_scaler()
 
         self.optimizer = torch.optim.Adam(
             [
@@ -276,8 +301,13 @@ class ShapeSpaceRunner:
                     "lr": self.lr_schedules[0].get_learning_rate(0),
                     "weight_decay": self.weight_decay
                 },
+            ])
+
+        # SparseAdam only reads and writes the moments of the latent codes in the batch
+        self.latent_optimizer = torch.optim.SparseAdam(
+            [
                 {
-                    "params": self.lat_vecs,
+                    "params": self.lat_vecs.parameters(),
                     "lr": self.lr_schedules[1].get_learning_rate(0)
                 },
             ])
@@ -287,18 +317,37 @@ class ShapeSpaceRunner:
         if is_continue:
             old_checkpnts_dir = os.path.join(self.expdir, timestamp, 'checkpoints')
 
-            data = torch.load(os.path.join(old_checkpnts_dir, self.latent_codes_subdir, str(kwargs['checkpoint']) + '.pth'))
-            self.lat_vecs = data["latent_codes"].cuda()
+            data = load_checkpoint(old_checkpnts_dir, kwargs['checkpoint'], map_location=self.device)
 
-            saved_model_state = torch.load(os.path.join(old_checkpnts_dir, 'ModelParameters', str(kwargs['checkpoint']) + ".pth"))
-            self.network.load_state_dict(saved_model_state["model_state_dict"])
+            # in place, the optimizer holds the latent codes tensor
+            with torch.no_grad():
+                self.lat_vecs.weight.copy_(data["latent_codes"])
 
-            data = torch.load(os.path.join(old_checkpnts_dir, 'OptimizerParameters', str(kwargs['checkpoint']) + ".pth"))
+            self.network.load_state_dict(data["model_state_dict"])
+            self.load_optimizer_state(data)
+            self.startepoch = data['epoch']
+
+    def load_optimizer_state(self, data):
+        if "latent_optimizer_state_dict" in data:
             self.optimizer.load_state_dict(data["optimizer_state_dict"])
-            self.startepoch = saved_model_state['epoch']
+            self.latent_optimizer.load_state_dict(data["latent_optimizer_state_dict"])
+            return
+
+        # earlier checkpoints kept the latent codes as the second group of the network Adam
+        state = data["optimizer_state_dict"]
+        network_group, latent_group = state["param_groups"]
+        self.optimizer.load_state_dict({"state": {i: state["state"][i] for i in network_group["params"] if i in state["state"]},
+                                        "param_groups": [network_group]})
+
+        latent_state = self.latent_optimizer.state_dict()
+        latent_state["param_groups"][0]["lr"] = latent_group["lr"]
+        if latent_group["params"][0] in state["state"]:
+            moments = state["state"][latent_group["params"][0]]
+            latent_state["state"] = {0: {"step": int(moments["step"]), "exp_avg": moments["exp_avg"], "exp_avg_sq": moments["exp_avg_sq"]}}
+        self.latent_optimizer.load_state_dict(latent_state)
 
     def latent_size_reg(self, indices):
-        latents = torch.index_select(self.lat_vecs, 0, indices)
+        latents = self.lat_vecs(indices)
         latent_loss = latents.norm(dim=1).mean()
         return latent_loss
 
@@ -327,43 +376,27 @@ class ShapeSpaceRunner:
         return schedules
 
     def add_latent(self, points, indices):
-        batch_size, num_of_points, dim = points.shape
-        points = points.reshape(batch_size * num_of_points, dim)
-        latent_inputs = torch.zeros(0).cuda()
+        return add_latent(points, self.lat_vecs(indices.to(self.device)))
 
-        for ind in indices.numpy():
-            latent_ind = self.lat_vecs[ind]
-            latent_repeat = latent_ind.expand(num_of_points, -1)
-            latent_inputs = torch.cat([latent_inputs, latent_repeat], 0)
-        points = torch.cat([latent_inputs, points], 1)
-        return points
+    def get_param_groups(self):
+        # network then latent codes, the order of the learning rate schedules
+        return self.optimizer.param_groups + self.latent_optimizer.param_groups
 
     def adjust_learning_rate(self, epoch):
-        for i, param_group in enumerate(self.optimizer.param_groups):
+        for i, param_group in enumerate(self.get_param_groups()):
             param_group["lr"] = self.lr_schedules[i].get_learning_rate(epoch)
 
+    def get_learning_rates(self):
+        return {"lr_{0}".format(i): param_group["lr"] for i, param_group in enumerate(self.get_param_groups())}
+
     def save_checkpoints(self,epoch):
 
-        torch.save(
-            {"epoch": epoch, "model_state_dict": self.network.state_dict()},
-            os.path.join(self.checkpoints_path, self.model_params_subdir, str(epoch) + ".pth"))
-        torch.save(
-            {"epoch": epoch, "model_state_dict": self.network.state_dict()},
-            os.path.join(self.checkpoints_path, self.model_params_subdir, "latest.pth"))
-
-        torch.save(
-            {"epoch": epoch, "optimizer_state_dict": self.optimizer.state_dict()},
-            os.path.join(self.checkpoints_path, self.optimizer_params_subdir, str(epoch) + ".pth"))
-        torch.save(
-            {"epoch": epoch, "optimizer_state_dict": self.optimizer.state_dict()},
-            os.path.join(self.checkpoints_path, self.optimizer_params_subdir, "latest.pth"))
-
-        torch.save(
-            {"epoch": epoch, "latent_codes": self.lat_vecs},
-            os.path.join(self.checkpoints_path, self.latent_codes_subdir, str(epoch) + ".pth"))
-        torch.save(
-            {"epoch": epoch, "latent_codes": self.lat_vecs},
-            os.path.join(self.checkpoints_path, self.latent_codes_subdir, "latest.pth"))
+        # latent_codes stays the (num_scenes, latent_size) tensor of the LatentCodes checkpoints
+        self.checkpoints.save(epoch,
+                              model_state_dict=self.network.state_dict(),
+                              optimizer_state_dict=self.optimizer.state_dict(),
+                              latent_optimizer_state_dict=self.latent_optimizer.state_dict(),
+                              latent_codes=self.lat_vecs.weight)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,50 @@
+import os
+import sys
+project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.append(project_dir)
+import pytest
+import torch
+from model.network import ImplicitNet, gradient
+
+
+@pytest.mark.parametrize("dims, skip_in", [([64] * 4, [2]), ([64] * 4, [4]), ([64] * 4, [2, 4]), ([64] * 6, [3, 6])])
+@pytest.mark.parametrize("d_in", [3, 35])
+def test_gradient_matches_autograd(dims, skip_in, d_in):
+    # with_gradient and the latent projection path against autograd.grad, skip layers up to the output layer included
+    torch.manual_seed(0)
+    network = ImplicitNet(d_in, dims, skip_in=skip_in).double()
+    pnts = torch.rand(200, d_in, dtype=torch.float64) * 2 - 1
+
+    pred, grad = network(pnts, with_gradient=True)
+
+    reference_pnts = pnts.clone().requires_grad_()
+    reference_pred = network(reference_pnts)
+    reference_grad = gradient(reference_pnts, reference_pred)
+
+    assert torch.allclose(pred, reference_pred)
+    assert torch.allclose(grad, reference_grad)
+
+    if d_in > 3:
+        latent_pnts = torch.cat([pnts[:1, :-3].expand(200, -1), pnts[:, -3:]], dim=-1).requires_grad_()
+        latent_reference_pred = network(latent_pnts)
+        latent_reference_grad = gradient(latent_pnts, latent_reference_pred)
+
+        latent_pred, latent_grad = network(pnts[:, -3:].unsqueeze(0), with_gradient=True, latent=pnts[:1, :-3])
+        assert torch.allclose(latent_pred.squeeze(0), latent_reference_pred)
+        assert torch.allclose(latent_grad.squeeze(0), latent_reference_grad)
+
+
+def test_gradient_is_differentiable():
+    # losses on the returned gradient train the network, also under torch.no_grad the gradient is returned
+    torch.manual_seed(0)
+    network = ImplicitNet(3, [32] * 4, skip_in=[4]).double()
+    pnts = torch.rand(100, 3, dtype=torch.float64)
+
+    pred, grad = network(pnts, with_gradient=True)
+    ((grad.norm(2, dim=-1) - 1) ** 2).mean().backward()
+    assert network.lin0.weight.grad.abs().sum() > 0
+
+    with torch.no_grad():
+        _, no_grad = network(pnts, with_gradient=True)
+    assert torch.allclose(no_grad, grad.detach())
+    assert not no_grad.requires_grad
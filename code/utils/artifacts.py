@@ -0,0 +1,54 @@
+import atexit
+import collections
+import concurrent.futures
+import multiprocessing
+
+
+def _run(fn, args, kwargs):
+    # results stay in the worker, only exceptions travel back
+    fn(*args, **kwargs)
+
+
+class ArtifactWriter:
+    """
+    Background writer for plots and meshes.
+
+    Jobs run in a process pool. At most max_pending jobs are queued, submit blocks on the oldest
+    one beyond that so the producer cannot run ahead of the exports unboundedly. Everything
+    still pending is flushed on close and at interpreter exit.
+
+    The workers are spawned, not forked: they start lazily during training, and a fork would copy
+    the locks and partly written state of other threads (e.g. the checkpoint writer).
+    """
+
+    def __init__(self, workers=2, max_pending=None):
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.max_pending = max_pending if not max_pending is None else 2 * workers
+        self.pending = collections.deque()
+        atexit.register(self.close)
+
+    def submit(self, fn, *args, **kwargs):
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.pool.submit(_run, fn, args, kwargs))
+
+    def flush(self):
+        while len(self.pending) > 0:
+            self.pending.popleft().result()
+
+    def close(self):
+        if self.pool is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown()
+            self.pool = None
+            atexit.unregister(self.close)
+
+
+def get_artifact_writer(workers):
+    # workers = 0 keeps the exports on the calling thread
+    if workers > 0:
+        return ArtifactWriter(workers)
+    return None
@@ -0,0 +1,113 @@
+import atexit
+import concurrent.futures
+import os
+import re
+import torch
+
+
+def to_cpu(obj):
+    # copy of a (nested) state dict with every tensor moved to host memory
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def get_checkpoint_file(checkpoints_path, checkpoint):
+    return os.path.join(checkpoints_path, '{0}.pth'.format(checkpoint))
+
+
+def load_checkpoint(checkpoints_path, checkpoint='latest', map_location=None):
+    """
+    Load the consolidated checkpoint ('latest' or an epoch) of checkpoints_path through mmap, so
+    tensors are paged in from the file instead of read up front.
+
+    Checkpoints of the former layout, one file per ModelParameters / OptimizerParameters /
+    LatentCodes subdirectory, are merged into the same dictionary.
+    """
+    filename = get_checkpoint_file(checkpoints_path, checkpoint)
+    if os.path.exists(filename):
+        return torch.load(filename, map_location=map_location, mmap=True, weights_only=False)
+
+    data = {}
+    for subdir in ['ModelParameters', 'OptimizerParameters', 'LatentCodes']:
+        filename = os.path.join(checkpoints_path, subdir, '{0}.pth'.format(checkpoint))
+        if os.path.exists(filename):
+            data.update(torch.load(filename, map_location=map_location, weights_only=False))
+
+    if len(data) == 0:
+        raise Exception('no checkpoint "{0}" in {1}'.format(checkpoint, checkpoints_path))
+    return data
+
+
+class CheckpointManager:
+    """
+    Asynchronous checkpoints with a retention policy.
+
+    save() snapshots the given state dicts to host memory on the calling thread and serializes them
+    on a background thread as one file per epoch, written to a temporary file and renamed into
+    place. latest.pth is a symlink to the newest epoch. At most one save is in flight. After
+    each save, only the keep_last newest epochs and the multiples of keep_every are kept
+    (keep_last = 0 keeps everything).
+    """
+
+    def __init__(self, checkpoints_path, keep_last=0, keep_every=0):
+        self.checkpoints_path = checkpoints_path
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        atexit.register(self.close)
+
+    def save(self, epoch, **state):
+        snapshot = to_cpu(state)
+        snapshot["epoch"] = epoch
+
+        self.wait()
+        self.pending = self.executor.submit(self.write, epoch, snapshot)
+
+    def write(self, epoch, snapshot):
+        filename = get_checkpoint_file(self.checkpoints_path, epoch)
+        torch.save(snapshot, filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+
+        # swap the symlink atomically as well
+        latest = get_checkpoint_file(self.checkpoints_path, 'latest')
+        if os.path.lexists(latest + '.tmp'):
+            os.remove(latest + '.tmp')
+        os.symlink(os.path.basename(filename), latest + '.tmp')
+        os.replace(latest + '.tmp', latest)
+
+        self.apply_retention()
+
+    def get_epochs(self):
+        epochs = [re.match(r'^(\d+)\.pth$', name) for name in os.listdir(self.checkpoints_path)]
+        return sorted(int(match.group(1)) for match in epochs if not match is None)
+
+    def apply_retention(self):
+        if self.keep_last <= 0:
+            return
+
+        epochs = self.get_epochs()
+        for epoch in epochs[:-self.keep_last]:
+            if self.keep_every > 0 and epoch % self.keep_every == 0:
+                continue
+            os.remove(get_checkpoint_file(self.checkpoints_path, epoch))
+
+    def wait(self):
+        if not self.pending is None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        if self.executor is None:
+            return
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown()
+            self.executor = None
+            atexit.unregister(self.close)
@@ -5,6 +5,7 @@ import trimesh
 import numpy as np
 
 import torch
+import utils.pointcloud as pointcloud
 
 
 def potential(x):
@@ -49,29 +50,101 @@ def get_class(kls):
     return m
 
 
-def to_cuda(torch_obj):
-    if torch.cuda.is_available():
-        return torch_obj.cuda()
-    else:
-        return torch_obj
+_device = None
 
 
-def load_point_cloud_files_from_folder(dir_path):
-    # TODO: take this from config
-    # ext = "xyz" 
-    ext = "xyz" 
+def set_device(device='auto', num_threads=0, num_interop_threads=0):
+    """
+    Select the device runners, samplers and plotting utilities place their tensors on.
+
+    device is 'auto' (cuda when available, else cpu) or any torch device string. A positive
+    num_threads / num_interop_threads sizes the intra-op and inter-op CPU thread pools.
+    """
+    global _device
+
+    if (device == 'auto'):
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    _device = torch.device(device)
+
+    if (num_threads > 0):
+        torch.set_num_threads(num_threads)
+    if (num_interop_threads > 0 and torch.get_num_interop_threads() != num_interop_threads):
+        # the inter-op pool can only be sized before its first use
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            print('inter-op threads already started, keeping {0}'.format(torch.get_num_interop_threads()))
+
+    print('device: {0}, cpu threads: {1} intra-op / {2} inter-op'.format(
+        _device, torch.get_num_threads(), torch.get_num_interop_threads()))
+
+    return _device
+
+
+def set_device_from_conf(conf):
+    device = set_device(conf.get_string('train.device', 'auto'),
+                        conf.get_int('train.num_threads', 0),
+                        conf.get_int('train.num_interop_threads', 0))
+    set_precision(conf.get_string('train.precision', 'fp32'))
+    return device
+
+
+def get_device():
+    if _device is None:
+        return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    return _device
+
+
+_precision = None
+
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def set_precision(precision='fp32'):
+    """
+    Select the autocast dtype of the mixed precision regions (see autocast): 'fp32' turns them off,
+    'bf16' or 'fp16'. fp16 needs cuda, other devices fall back to bf16.
+    """
+    global _precision
+
+    if not precision in PRECISIONS:
+        raise Exception('no known precision "{}"'.format(precision))
+
+    _precision = PRECISIONS[precision]
+    if (_precision == torch.float16 and get_device().type != 'cuda'):
+        print('fp16 autocast needs cuda, using bf16 on {0}'.format(get_device()))
+        _precision = torch.bfloat16
+
+    print('precision: {0}'.format('fp32' if _precision is None else str(_precision).replace('torch.', '')))
+    return _precision
+
+
+def get_precision():
+    return _precision
+
+
+def autocast():
+    # mixed precision region on the current device, a no-op in fp32
+    return torch.autocast(get_device().type,
+                          dtype=_precision if not _precision is None else torch.bfloat16,
+                          enabled=not _precision is None)
+
+
+def get_grad_scaler():
+    # loss scaling, only enabled for fp16 whose gradients would underflow
+    return torch.amp.GradScaler(get_device().type, enabled=_precision == torch.float16)
+
+
+def to_device(torch_obj):
+    # no copy when the tensor / module already lives on the device, asynchronous from pinned memory
+    return torch_obj.to(get_device(), non_blocking=True)
 
-    tensor_list = []
-    for file in glob.glob(f"{dir_path}/*.{ext}"):
-        print(f"loading file {file}")
-        if (ext == "npy"):
-            tensor_list.append(torch.from_numpy(np.load(file)).float())
-        else:
-            tensor_list.append(torch.tensor(trimesh.load(file, ext).vertices).float())
-        print(tensor_list[-1].shape)
 
-    point_set = torch.vstack(tensor_list)
-    point_set = point_set - torch.mean(point_set)
+def load_point_cloud_files_from_folder(dir_path, ext="xyz"):
+    # every column of the files is kept, the xyz columns are centered; the cached points are
+    # memory-mapped copy-on-write, so only the centering writes make private pages, without a full copy
+    point_set = torch.from_numpy(np.asarray(pointcloud.load_point_clouds(dir_path, ext), dtype=np.float32))
+    point_set[:, :3] = point_set[:, :3] - torch.mean(point_set[:, :3])
     print(f"data shape = {point_set.shape}")
 
     return point_set
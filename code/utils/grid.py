@@ -0,0 +1,65 @@
+import numpy as np
+import torch
+import utils.general as utils
+
+
+class Grid:
+    """
+    Lazy description of an axis aligned lattice.
+
+    Nodes are ordered with x as the slowest and z as the fastest index, so a flat array of values
+    reshapes to a (len(x), len(y), len(z)) volume. Points are only generated per tile, on the grid
+    device, instead of materializing all N^3 of them up front.
+    """
+
+    def __init__(self, xyz, shortest_axis_length=None, shortest_axis_index=None, device=None):
+        self.xyz = xyz
+        self.shortest_axis_length = shortest_axis_length
+        self.shortest_axis_index = shortest_axis_index
+        self.shape = tuple(axis.shape[0] for axis in xyz)
+        self.device = device if not device is None else utils.get_device()
+        self._axes = None
+
+    def __getitem__(self, key):
+        # keep the dict interface of the former get_grid output
+        return getattr(self, key)
+
+    @property
+    def origin(self):
+        return np.array([axis[0] for axis in self.xyz])
+
+    @property
+    def spacing(self):
+        return self.xyz[0][2] - self.xyz[0][1]
+
+    @property
+    def num_points(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def axes(self):
+        if self._axes is None:
+            self._axes = [torch.tensor(axis, dtype=torch.float, device=self.device) for axis in self.xyz]
+        return self._axes
+
+    @property
+    def grid_points(self):
+        return self.get_points(0, self.num_points)
+
+    def points(self, ids):
+        return torch.stack([self.axes[i][ids[:, i]] for i in range(3)], dim=1)
+
+    def unravel(self, flat):
+        _, ny, nz = self.shape
+        return torch.stack([flat // (ny * nz), (flat // nz) % ny, flat % nz], dim=1)
+
+    def get_points(self, start, end):
+        return self.points(self.unravel(torch.arange(start, end, device=self.device)))
+
+    def get_planes(self, lo, hi):
+        _, ny, nz = self.shape
+        return self.get_points(lo * ny * nz, hi * ny * nz)
+
+    def tiles(self, tile_size=100000):
+        for start in range(0, self.num_points, tile_size):
+            yield self.get_points(start, min(start + tile_size, self.num_points))
@@ -0,0 +1,405 @@
+import itertools
+import numpy as np
+import trimesh
+import torch
+import torch.nn.functional as F
+from skimage import measure
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import utils.general as utils
+from utils.grid import Grid
+from model.network import get_latent_decoder
+
+
+def eval_sdf(decoder, pnts, latent=None, chunk_size=100000):
+    if (not latent is None):
+        decoder = get_latent_decoder(decoder, latent)
+    z = []
+    for chunk in torch.split(pnts, chunk_size, dim=0):
+        with utils.autocast():
+            z.append(decoder(chunk).detach().squeeze(-1))
+    if len(z) == 0:
+        return pnts.new_zeros(0)
+    return torch.cat(z, dim=0)
+
+
+def eval_sdf_gradient(decoder, pnts, latent=None, chunk_size=100000):
+    # values and spatial gradients of the decoder, also when called under torch.no_grad
+    if (not latent is None):
+        decoder = get_latent_decoder(decoder, latent)
+    z = []
+    grads = []
+    with torch.enable_grad():
+        for chunk in torch.split(pnts, chunk_size, dim=0):
+            chunk = chunk.detach().requires_grad_()
+            with utils.autocast():
+                pred = decoder(chunk)
+            grads.append(torch.autograd.grad(pred.sum(), chunk)[0][:, -3:].detach())
+            z.append(pred.detach().squeeze(-1))
+    return torch.cat(z, dim=0), torch.cat(grads, dim=0)
+
+
+def get_volumes(decoder, latents, grid, chunk_size=100000, verbose=False):
+    """
+    Evaluate the decoder for K latents over the same grid, one batched pass per tile.
+    Returns an array of shape (K,) + grid.shape.
+    """
+    decoder = get_latent_decoder(decoder, latents)
+    num_latents = latents.shape[0]
+    tile_size = max(chunk_size // num_latents, 1)
+
+    z = []
+    for i, pnts in enumerate(grid.tiles(tile_size)):
+        if (verbose):
+            print('{0}'.format(i / max(grid.num_points // tile_size, 1) * 100))
+        with utils.autocast():
+            z.append(decoder(pnts.unsqueeze(0).expand(num_latents, -1, -1)).detach().squeeze(-1).cpu().numpy())
+    return np.concatenate(z, axis=1).reshape((num_latents,) + grid.shape)
+
+
+def get_volume_surface(z, spacing, origin, mc_value):
+    if (np.min(z) > mc_value or np.max(z) < mc_value):
+        return None
+
+    verts, faces, normals, values = measure.marching_cubes(
+        volume=z.astype(np.float32, copy=False),
+        level=mc_value,
+        spacing=(spacing, spacing, spacing))
+
+    return verts + origin, faces, normals, values
+
+
+def get_mesh(surface, connected=False):
+    verts, faces, normals, values = surface
+    mesh = trimesh.Trimesh(verts, faces, normals, vertex_colors=values)
+    if connected:
+        mesh = filter_components(mesh)
+    return mesh
+
+
+def label_components(faces):
+    """
+    Label the edge connected components of a triangle soup, returns (num_components, face_labels).
+    Faces sharing an edge are linked through a sparse adjacency graph instead of building a mesh per component.
+    """
+    edges = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1).astype(np.int64)
+    edge_ids = edges[:, 0] * (edges[:, 1].max() + 1) + edges[:, 1]
+
+    order = np.argsort(edge_ids)
+    edge_ids = edge_ids[order]
+    edge_faces = order // 3
+
+    # consecutive faces around the same edge are adjacent, this chains non manifold edges as well
+    shared = edge_ids[1:] == edge_ids[:-1]
+    adjacency = coo_matrix((np.ones(shared.sum(), dtype=np.int8), (edge_faces[:-1][shared], edge_faces[1:][shared])),
+                           shape=(faces.shape[0], faces.shape[0]))
+
+    return connected_components(adjacency, directed=False)
+
+
+def filter_components(mesh, num_components=1, min_area_fraction=None):
+    """
+    Keep the num_components largest connected components by area, or, with min_area_fraction,
+    every component holding at least that fraction of the total area.
+    """
+    if len(mesh.faces) == 0:
+        return mesh
+
+    num_labels, labels = label_components(mesh.faces)
+    areas = np.bincount(labels, weights=mesh.area_faces, minlength=num_labels)
+
+    if min_area_fraction is None:
+        keep_labels = np.argsort(-areas, kind='stable')[:num_components]
+    else:
+        keep_labels = np.flatnonzero(areas >= min_area_fraction * areas.sum())
+
+    mesh = mesh.copy()
+    mesh.update_faces(np.isin(labels, keep_labels))
+    mesh.remove_unreferenced_vertices()
+    return mesh
+
+
+def export_surface_mesh(surface, mc_value, filename, connected=False):
+    # meshing and export of a plots.get_surface result (evaluated volume or extracted surface), used from worker processes
+    if ("volume" in surface):
+        surface = get_volume_surface(surface["volume"], surface["spacing"], surface["origin"], mc_value)
+    else:
+        surface = surface["surface"]
+    if surface is None:
+        return None
+    get_mesh(surface, connected).export(filename + '.ply', 'ply')
+    return filename + '.ply'
+
+
+def get_octree_levels(shape, coarse_resolution=32):
+    return max(int(np.floor(np.log2((max(shape) - 1) / coarse_resolution))), 0)
+
+
+def _extend_axis(axis, size, spacing):
+    # keep the original node positions and extrapolate the padding nodes past the end
+    extended = axis[0] + np.arange(size) * spacing
+    extended[:axis.shape[0]] = axis[:size]
+    return extended
+
+
+def _cell_min(values):
+    nx, ny, nz = [n - 1 for n in values.shape]
+    cell_min = values[:nx, :ny, :nz]
+    for dx, dy, dz in itertools.product((0, 1), repeat=3):
+        cell_min = torch.minimum(cell_min, values[dx:dx + nx, dy:dy + ny, dz:dz + nz])
+    return cell_min
+
+
+def _cell_corners(cells):
+    nx, ny, nz = cells.shape
+    nodes = torch.zeros(nx + 1, ny + 1, nz + 1, dtype=torch.bool, device=cells.device)
+    for dx, dy, dz in itertools.product((0, 1), repeat=3):
+        nodes[dx:dx + nx, dy:dy + ny, dz:dz + nz] |= cells
+    return nodes
+
+
+def get_octree_volume(decoder, latent, grid, mc_value, levels=None, chunk_size=100000, verbose=False):
+    """
+    Coarse to fine evaluation of the decoder on the nodes of grid.
+
+    Starts from a grid subsampled by 2**levels and at every level refines only the cells with
+    min |f - mc_value| over their corners smaller than the cell diagonal. Cells that are skipped
+    cannot contain the level set as long as f is 1-Lipschitz (eikonal regularization), so their
+    nodes are filled by trilinear interpolation which preserves the sign. The returned volume
+    has shape grid.shape and gives the same marching cubes mesh as the dense grid.
+    """
+    shape = grid.shape
+    spacing = grid.spacing
+    device = grid.device
+
+    if levels is None:
+        levels = get_octree_levels(shape)
+
+    step = 2 ** levels
+    coarse_shape = [int(np.ceil((n - 1) / step)) + 1 for n in shape]
+    fine_shape = [(n - 1) * step + 1 for n in coarse_shape]
+    padded = Grid([_extend_axis(axis, n, spacing) for axis, n in zip(grid.xyz, fine_shape)], device=device)
+
+    def evaluate(ids, stride):
+        return eval_sdf(decoder, padded.points(ids * stride), latent, chunk_size)
+
+    ids = torch.stack(torch.meshgrid([torch.arange(n, device=device) for n in coarse_shape], indexing='ij'), dim=-1)
+    values = evaluate(ids.reshape(-1, 3), step).reshape(coarse_shape)
+    exact = torch.ones(coarse_shape, dtype=torch.bool, device=device)
+    cells = None
+    evaluated = values.numel()
+
+    for level in range(levels):
+        stride = step // (2 ** level)
+        diagonal = np.sqrt(3) * stride * spacing
+
+        refine = _cell_min((values - mc_value).abs()) < diagonal
+        if not cells is None:
+            refine &= cells
+
+        coarse_values = values
+        values = F.interpolate(coarse_values[None, None], size=[2 * n - 1 for n in coarse_values.shape],
+                               mode='trilinear', align_corners=True)[0, 0]
+        values[::2, ::2, ::2] = coarse_values
+        exact_up = torch.zeros(values.shape, dtype=torch.bool, device=device)
+        exact_up[::2, ::2, ::2] = exact
+
+        cells = refine.repeat_interleave(2, dim=0).repeat_interleave(2, dim=1).repeat_interleave(2, dim=2)
+        todo = _cell_corners(cells) & ~exact_up
+
+        ids = todo.nonzero()
+        values[todo] = evaluate(ids, stride // 2)
+        exact = exact_up | todo
+        evaluated += ids.shape[0]
+
+        if (verbose):
+            print('octree level {0}/{1}: {2} refined cells, {3} new queries'.format(level + 1, levels, refine.sum().item(), ids.shape[0]))
+
+    if (verbose):
+        print('octree: {0} queries instead of {1}'.format(evaluated, np.prod(shape)))
+
+    return values[:shape[0], :shape[1], :shape[2]]
+
+
+def _weld(prev_keys, prev_ids, keys):
+    # match vertices of two neighbouring slabs lying on their shared plane by their exact (y, z) position
+    matched = np.full(keys.shape[0], -1, dtype=np.int64)
+    if prev_keys.shape[0] == 0 or keys.shape[0] == 0:
+        return matched
+    _, inverse = np.unique(np.concatenate([prev_keys, keys], axis=0), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    lookup = np.full(inverse.max() + 1, -1, dtype=np.int64)
+    lookup[inverse[:prev_keys.shape[0]]] = prev_ids
+    return lookup[inverse[prev_keys.shape[0]:]]
+
+
+def get_slab_surface(decoder, latent, grid, mc_value, slab_size=32, chunk_size=100000, verbose=False):
+    """
+    Out of core marching cubes over the nodes of grid.
+
+    The decoder is evaluated plane by plane along x and marching cubes runs on slabs of slab_size
+    cells (plus one plane of padding on each side, so vertex normals see the same central
+    differences as a single pass). Vertices on the plane shared by two slabs are welded, so the
+    result is the single pass mesh up to vertex and face ordering while only O(slab_size * N^2)
+    values are held at a time. Returns (verts, faces, normals, values) in world coordinates or
+    None if the level set does not cross the grid.
+    """
+    nx, ny, nz = grid.shape
+
+    def evaluate_planes(lo, hi):
+        return eval_sdf(decoder, grid.get_planes(lo, hi), latent, chunk_size).reshape(hi - lo, ny, nz).cpu().numpy()
+
+    window_lo = 0
+    window = np.zeros((0, ny, nz), dtype=np.float32)
+
+    verts, faces, normals, values = [], [], [], []
+    num_verts = 0
+    prev_keys = np.zeros((0, 2))
+    prev_ids = np.zeros(0, dtype=np.int64)
+
+    for start in range(0, nx - 1, slab_size):
+        end = min(start + slab_size, nx - 1)
+        lo = max(start - 1, 0)
+        hi = min(end + 1, nx - 1)
+
+        # slide the window of evaluated planes to [lo, hi]
+        window_hi = window_lo + window.shape[0]
+        if hi + 1 > window_hi:
+            window = np.concatenate([window, evaluate_planes(window_hi, hi + 1)], axis=0)
+        window = window[lo - window_lo:]
+        window_lo = lo
+        slab = window[:hi + 1 - lo]
+
+        if (verbose):
+            print('slab {0}/{1}'.format(end, nx - 1))
+
+        if np.min(slab) > mc_value or np.max(slab) < mc_value:
+            prev_keys = np.zeros((0, 2))
+            prev_ids = np.zeros(0, dtype=np.int64)
+            continue
+
+        slab_verts, slab_faces, slab_normals, slab_values = measure.marching_cubes(volume=slab.astype(np.float32, copy=False), level=mc_value)
+        slab_verts[:, 0] += lo
+
+        # keep the faces of the cells [start, end) and drop the ones of the padding cells
+        centers = slab_verts[slab_faces][:, :, 0].mean(axis=1)
+        keep = (centers >= start) & ((centers < end) | ((centers == end) & (end == nx - 1)))
+        slab_faces = slab_faces[keep]
+
+        used, slab_faces = np.unique(slab_faces, return_inverse=True)
+        slab_faces = slab_faces.reshape(-1, 3)
+        slab_verts = slab_verts[used]
+
+        # weld the vertices on the plane shared with the previous slab
+        on_start = slab_verts[:, 0] == start
+        matched = _weld(prev_keys, prev_ids, slab_verts[on_start, 1:])
+        ids = np.full(slab_verts.shape[0], -1, dtype=np.int64)
+        ids[on_start] = matched
+        new = ids < 0
+        ids[new] = num_verts + np.arange(new.sum())
+        num_verts += new.sum()
+
+        verts.append(slab_verts[new])
+        normals.append(slab_normals[used][new])
+        values.append(slab_values[used][new])
+        faces.append(ids[slab_faces])
+
+        on_end = slab_verts[:, 0] == end
+        prev_keys = slab_verts[on_end, 1:]
+        prev_ids = ids[on_end]
+
+    if num_verts == 0:
+        return None
+
+    verts = np.concatenate(verts, axis=0) * grid.spacing + grid.origin
+    return verts, np.concatenate(faces, axis=0), np.concatenate(normals, axis=0), np.concatenate(values, axis=0)
+
+
+# (u, v) axes around the edges along x, y and z, ordered so that u x v points along the edge
+_DUAL_AXES = [(1, 2), (2, 0), (0, 1)]
+
+
+def get_dual_contouring_surface(decoder, latent, grid, mc_value, chunk_size=100000, verbose=False):
+    """
+    Dual contouring on the nodes of grid.
+
+    Every cell crossed by the level set gets one vertex minimizing the QEF of the tangent planes
+    at its edge crossings, with normals from the decoder gradient, and every crossed edge gives
+    a quad between its four cells. Degenerate QEFs (flat regions) fall back towards the mass
+    point of the crossings through a truncated pseudo inverse, as in surface nets, and vertices
+    are clamped to their cell. The volume is evaluated with the octree. Returns
+    (verts, faces, normals, values) like marching cubes, or None.
+    """
+    z = get_octree_volume(decoder, latent, grid, mc_value, chunk_size=chunk_size, verbose=verbose).cpu().numpy()
+
+    if (np.min(z) > mc_value or np.max(z) < mc_value):
+        return None
+
+    inside = z < mc_value
+    cell_shape = np.array(z.shape) - 1
+
+    edge_points, edge_cells, edge_quads = [], [], []
+    for axis, (u, v) in enumerate(_DUAL_AXES):
+        lo = [slice(None)] * 3
+        hi = [slice(None)] * 3
+        lo[axis] = slice(0, -1)
+        hi[axis] = slice(1, None)
+        lo, hi = tuple(lo), tuple(hi)
+
+        crossing = inside[lo] != inside[hi]
+        ids = np.argwhere(crossing)
+        z0 = z[lo][crossing]
+        z1 = z[hi][crossing]
+
+        points = ids.astype(np.float64)
+        points[:, axis] += (mc_value - z0) / (z1 - z0)
+        edge_points.append(points)
+
+        # the four cells around each edge, counter clockwise in the (u, v) plane
+        cells = np.repeat(ids[:, None, :], 4, axis=1)
+        cells[:, [0, 3], u] -= 1
+        cells[:, [0, 1], v] -= 1
+        valid = np.all((cells >= 0) & (cells < cell_shape), axis=-1)
+        edge_cells.append(np.where(valid, np.ravel_multi_index(tuple(np.clip(cells, 0, cell_shape - 1).transpose(2, 0, 1)), cell_shape), -1))
+
+        # keep the quads of edges inside the volume, orient them from inside to outside
+        quads = edge_cells[-1][valid.all(axis=1)]
+        flip = ~inside[lo][crossing][valid.all(axis=1)]
+        quads[flip] = quads[flip][:, ::-1]
+        edge_quads.append(quads)
+
+    edge_points = np.concatenate(edge_points, axis=0)
+    edge_cells = np.concatenate(edge_cells, axis=0)
+    edge_quads = np.concatenate(edge_quads, axis=0)
+
+    pnts = torch.tensor(edge_points * grid.spacing + grid.origin, dtype=torch.float, device=grid.device)
+    _, edge_normals = eval_sdf_gradient(decoder, pnts, latent, chunk_size)
+    edge_normals = F.normalize(edge_normals, dim=-1).cpu().numpy().astype(np.float64)
+
+    # accumulate the QEF of every active cell from the crossings on its edges
+    cell_edges, cell_slots = np.nonzero(edge_cells >= 0)
+    active, cell_ids = np.unique(edge_cells[cell_edges, cell_slots], return_inverse=True)
+    cell_ids = cell_ids.reshape(-1)
+
+    p = edge_points[cell_edges]
+    n = edge_normals[cell_edges]
+    nnt = n[:, :, None] * n[:, None, :]
+    ata = np.stack([np.bincount(cell_ids, weights=nnt[:, i, j], minlength=active.shape[0]) for i in range(3) for j in range(3)], axis=-1).reshape(-1, 3, 3)
+    atb = np.stack([np.bincount(cell_ids, weights=n[:, i] * (n * p).sum(-1), minlength=active.shape[0]) for i in range(3)], axis=-1)
+    count = np.bincount(cell_ids, minlength=active.shape[0])
+    mass = np.stack([np.bincount(cell_ids, weights=p[:, i], minlength=active.shape[0]) for i in range(3)], axis=-1) / count[:, None]
+
+    U, S, Vt = np.linalg.svd(ata)
+    S_inv = np.where(S > 0.1 * S[:, :1], 1.0 / np.maximum(S, 1e-12), 0.0)
+    residual = atb - np.einsum('nij,nj->ni', ata, mass)
+    verts = mass + np.einsum('nji,nj,nkj,nk->ni', Vt, S_inv, U, residual)
+
+    cell_origin = np.stack(np.unravel_index(active, cell_shape), axis=-1)
+    verts = np.clip(verts, cell_origin, cell_origin + 1) * grid.spacing + grid.origin
+
+    quads = np.searchsorted(active, edge_quads)
+    faces = np.concatenate([quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]], axis=0)
+
+    values, normals = eval_sdf_gradient(decoder, torch.tensor(verts, dtype=torch.float, device=grid.device), latent, chunk_size)
+
+    return verts, faces, F.normalize(normals, dim=-1).cpu().numpy(), values.cpu().numpy()
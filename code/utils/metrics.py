@@ -0,0 +1,137 @@
+import os
+import csv
+import json
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+
+
+def subsample(points, num_samples, normals=None, seed=0):
+    if num_samples is None or points.shape[0] <= num_samples:
+        return points, normals
+    idx = np.random.default_rng(seed).choice(points.shape[0], num_samples, replace=False)
+    return points[idx], (normals[idx] if not normals is None else None)
+
+
+def surface_metrics(pred_points, gt_points, pred_normals=None, gt_normals=None, fscore_thresholds=(0.01, 0.02), num_samples=100000):
+    """
+    Chamfer-L1/L2, normal consistency and F-scores between a predicted surface sample
+    (e.g. mesh vertices) and the input points, with nearest neighbours from KD-trees.
+
+    Chamfer distances are the mean of both directions. Normal consistency needs both normal
+    sets and is the mean absolute cosine to the nearest neighbour normal, in both directions.
+    """
+    pred_points, pred_normals = subsample(np.asarray(pred_points, dtype=np.float64), num_samples, pred_normals)
+    gt_points, gt_normals = subsample(np.asarray(gt_points, dtype=np.float64), num_samples, gt_normals)
+
+    # distances from the prediction to the input (accuracy) and from the input to the prediction (completeness)
+    accuracy, accuracy_idx = cKDTree(gt_points).query(pred_points, workers=-1)
+    completeness, completeness_idx = cKDTree(pred_points).query(gt_points, workers=-1)
+
+    metrics = {"chamfer_l1": 0.5 * (accuracy.mean() + completeness.mean()),
+               "chamfer_l2": 0.5 * ((accuracy ** 2).mean() + (completeness ** 2).mean())}
+
+    if not pred_normals is None and not gt_normals is None:
+        pred_normals = pred_normals / np.linalg.norm(pred_normals, axis=-1, keepdims=True).clip(min=1e-12)
+        gt_normals = gt_normals / np.linalg.norm(gt_normals, axis=-1, keepdims=True).clip(min=1e-12)
+        accuracy_normals = np.abs((pred_normals * gt_normals[accuracy_idx]).sum(axis=-1))
+        completeness_normals = np.abs((gt_normals * pred_normals[completeness_idx]).sum(axis=-1))
+        metrics["normal_consistency"] = 0.5 * (accuracy_normals.mean() + completeness_normals.mean())
+
+    for threshold in fscore_thresholds:
+        precision = (accuracy < threshold).mean()
+        recall = (completeness < threshold).mean()
+        fscore = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+        metrics["fscore@{0}".format(threshold)] = fscore
+
+    return {k: float(v) for k, v in metrics.items()}
+
+
+def mesh_metrics(mesh, points, normals=None, fscore_thresholds=(0.01, 0.02), num_samples=100000):
+    return surface_metrics(mesh.vertices, points,
+                           pred_normals=mesh.vertex_normals if not normals is None else None,
+                           gt_normals=normals,
+                           fscore_thresholds=fscore_thresholds,
+                           num_samples=num_samples)
+
+
+def write_metrics(filename, **record):
+    # one json record per line, appended
+    with open(filename, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def read_metrics(filename):
+    # records of a jsonl or csv metrics file, csv values as floats
+    with open(filename) as f:
+        if filename.endswith('.csv'):
+            return [{k: float(v) for k, v in row.items() if v != ''} for row in csv.DictReader(f)]
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def format_metrics(record, keys):
+    return '\t'.join('{0}: {1:.6f}'.format(key, record[key]) for key in keys)
+
+
+class MetricLogger:
+    """
+    Running means of training scalars, accumulated on the device.
+
+    update() only adds the detached loss tensors to device side sums, so the training loop never
+    waits on the host. Every flush_frequency updates the means are copied to the host at once and
+    appended, together with the host side values (step, learning rates, ...), as one record to
+    filename, a .jsonl or .csv file.
+    """
+
+    def __init__(self, filename, flush_frequency=100):
+        self.filename = filename
+        self.flush_frequency = flush_frequency
+        self.sums = {}
+        self.count = 0
+        self.fieldnames = None
+
+    def update(self, step, host_values=None, **values):
+        # returns the flushed record every flush_frequency updates, None otherwise
+        for key, value in values.items():
+            value = value.detach()
+            self.sums[key] = self.sums[key] + value if key in self.sums else value.clone()
+        self.count += 1
+        self.step = step
+        self.host_values = host_values if not host_values is None else {}
+
+        if self.count >= self.flush_frequency:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if self.count == 0:
+            return None
+
+        keys = list(self.sums.keys())
+        means = (torch.stack([self.sums[key].reshape(()) for key in keys]) / self.count).tolist()
+
+        record = {"step": self.step, "num_steps": self.count}
+        record.update(self.host_values)
+        record.update(zip(keys, means))
+
+        if self.filename.endswith('.csv'):
+            self.write_csv(record)
+        else:
+            write_metrics(self.filename, **record)
+
+        self.sums = {}
+        self.count = 0
+        return record
+
+    def write_csv(self, record):
+        # the header is fixed by the first record, or by the file when appending to an existing log
+        if self.fieldnames is None:
+            if os.path.exists(self.filename) and os.path.getsize(self.filename) > 0:
+                with open(self.filename, newline='') as f:
+                    self.fieldnames = next(csv.reader(f))
+            else:
+                self.fieldnames = list(record.keys())
+                with open(self.filename, 'a', newline='') as f:
+                    csv.writer(f).writerow(self.fieldnames)
+        with open(self.filename, 'a', newline='') as f:
+            csv.DictWriter(f, fieldnames=self.fieldnames, extrasaction='ignore').writerow(record)
@@ -3,10 +3,12 @@ import plotly.graph_objs as go
 import plotly.offline as offline
 import torch
 import numpy as np
-from skimage import measure
 import os
 import utils.general as utils
-from chamferdist import ChamferDistance
+import utils.meshing as meshing
+import utils.metrics as metrics
+from model.network import get_latent_decoder
+from utils.grid import Grid
 
 
 def get_threed_scatter_trace(points,caption = None,colorscale = None,color = None):
@@ -64,47 +66,78 @@ def plot_threed_scatter(points,path,epoch,in_epoch):
     offline.plot(fig1, filename=filename, auto_open=False)
 
 
-def plot_surface(decoder,path,epoch, shapename,resolution,mc_value,is_uniform_grid,verbose,save_html,save_ply,overwrite, points=None, with_points=False, latent=None, connected=False):
+def plot_surface(decoder,path,epoch, shapename,resolution,mc_value,is_uniform_grid,verbose,save_html,save_ply,overwrite, points=None, with_points=False, latent=None, connected=False, extraction='dense',
+                 normals=None, metrics_samples=100000, fscore_thresholds=(0.01, 0.02), writer=None):
 
     filename = '{0}/igr_{1}_{2}'.format(path, epoch, shapename)
-    chamferDist = ChamferDistance()
 
     if (not os.path.exists(filename) or overwrite):
 
+        caption = None
         if with_points:
             pnts_val = decoder(points)
             pnts_val = pnts_val.cpu()
-            points = points.cpu()
             caption = ["decoder : {0}".format(val.item()) for val in pnts_val.squeeze()]
-            trace_pnts = get_threed_scatter_trace(points[:,-3:],caption=caption)
 
-        surface = get_surface_trace(points,decoder,latent,resolution,mc_value,is_uniform_grid,verbose,save_ply, connected)
-        trace_surface = surface["mesh_trace"]
-        dist = chamferDist(torch.tensor(surface["mesh_export"].vertices).float().unsqueeze(dim=0), points.unsqueeze(dim=0)).detach().cpu().item()
-        filename = '{}_{}'.format(filename, np.round(dist, 4))
-        print(f"Chamfer distance: {dist}")
+        surface = get_surface(points,decoder,latent,resolution,mc_value,is_uniform_grid,verbose,extraction)
 
+        # only the network evaluation above needs the decoder, the rest can run in the artifact writer
+        args = (surface, path, epoch, shapename, mc_value, save_html, save_ply, connected,
+                points[:, -3:].detach().cpu().numpy() if not points is None else None,
+                caption,
+                normals.detach().cpu().numpy() if not normals is None else None,
+                metrics_samples, fscore_thresholds)
+
+        if writer is None:
+            return export_surface(*args)
+        writer.submit(export_surface, *args)
+
+
+def export_surface(surface, path, epoch, shapename, mc_value, save_html, save_ply, connected, points=None, caption=None, normals=None, metrics_samples=100000, fscore_thresholds=(0.01, 0.02)):
+
+    filename = '{0}/igr_{1}_{2}'.format(path, epoch, shapename)
+
+    # the mesh is built for the metrics as well, whether or not it is exported
+    surface = build_surface_trace(surface, mc_value, save_ply or not points is None, connected, with_trace=save_html)
+    trace_surface = surface["mesh_trace"]
+
+    if (not surface["mesh_export"] is None and not points is None):
+        surface_metrics = metrics.mesh_metrics(surface["mesh_export"],
+                                               points,
+                                               normals=normals,
+                                               fscore_thresholds=fscore_thresholds,
+                                               num_samples=metrics_samples)
+        metrics.write_metrics(os.path.join(path, 'metrics.jsonl'), epoch=epoch, shapename=shapename, **surface_metrics)
+        print('metrics: {0}'.format(surface_metrics))
+
+    if (save_html):
         layout = go.Layout(title= go.layout.Title(text=shapename), width=1200, height=1200, scene=dict(xaxis=dict(range=[-2, 2], autorange=False),
                                                                yaxis=dict(range=[-2, 2], autorange=False),
                                                                zaxis=dict(range=[-2, 2], autorange=False),
                                                                aspectratio=dict(x=1, y=1, z=1)))
-        if (with_points):
-            fig1 = go.Figure(data=trace_pnts + trace_surface, layout=layout)
+        if (not caption is None):
+            fig1 = go.Figure(data=get_threed_scatter_trace(points,caption=caption) + trace_surface, layout=layout)
         else:
             fig1 = go.Figure(data=trace_surface, layout=layout)
 
+        offline.plot(fig1, filename=filename + '.html', auto_open=False)
+    if (save_ply and not surface['mesh_export'] is None):
+        surface['mesh_export'].export(filename + '.ply', 'ply')
+    return surface['mesh_export']
 
-        if (save_html):
-            offline.plot(fig1, filename=filename + '.html', auto_open=False)
-        if (not surface['mesh_export'] is None):
-            surface['mesh_export'].export(filename + '.ply', 'ply')
-        return surface['mesh_export']
 
+def get_surface_trace(points,decoder,latent,resolution,mc_value,is_uniform,verbose,save_ply, connected=False, extraction='dense'):
 
-def get_surface_trace(points,decoder,latent,resolution,mc_value,is_uniform,verbose,save_ply, connected=False):
+    surface = get_surface(points,decoder,latent,resolution,mc_value,is_uniform,verbose,extraction)
+    return build_surface_trace(surface, mc_value, save_ply, connected)
 
-    trace = []
-    meshexport = None
+
+def get_surface(points,decoder,latent,resolution,mc_value,is_uniform,verbose,extraction='dense'):
+    """
+    Network side of the surface extraction. Returns either the evaluated volume with its
+    lattice ({"volume", "spacing", "origin"}) or, for the slab and dual contouring extractions,
+    the extracted surface ({"surface"}). build_surface_trace turns either one into the mesh and trace.
+    """
 
     if (is_uniform):
         grid = get_grid_uniform(resolution)
@@ -114,84 +147,111 @@ def get_surface_trace(points,decoder,latent,resolution,mc_value,is_uniform,verbo
         else:
             grid = get_grid(None, resolution)
 
-    z = []
+    if (extraction == 'slab'):
+        return {"surface": meshing.get_slab_surface(decoder, latent, grid, mc_value, verbose=verbose)}
 
-    for i,pnts in enumerate(torch.split(grid['grid_points'],100000,dim=0)):
-        if (verbose):
-            print ('{0}'.format(i/(grid['grid_points'].shape[0] // 100000) * 100))
+    if (extraction == 'dual_contouring'):
+        return {"surface": meshing.get_dual_contouring_surface(decoder, latent, grid, mc_value, verbose=verbose)}
 
+    if (extraction == 'octree'):
+        z = meshing.get_octree_volume(decoder, latent, grid, mc_value, verbose=verbose).cpu().numpy()
+
+    elif (extraction == 'dense'):
+        z = []
         if (not latent is None):
-            pnts = torch.cat([latent.expand(pnts.shape[0], -1), pnts], dim=1)
-        z.append(decoder(pnts).detach().cpu().numpy())
-    z = np.concatenate(z,axis=0)
+            decoder = get_latent_decoder(decoder, latent)
 
-    if (not (np.min(z) > mc_value or np.max(z) < mc_value)):
+        for i,pnts in enumerate(grid.tiles(100000)):
+            if (verbose):
+                print ('{0}'.format(i/(grid.num_points // 100000) * 100))
 
-        import trimesh
-        z  = z.astype(np.float64)
+            with utils.autocast():
+                z.append(decoder(pnts).detach().cpu().numpy())
+        z = np.concatenate(z,axis=0).reshape(grid.shape)
 
-        verts, faces, normals, values = measure.marching_cubes(
-            volume=z.reshape(grid['xyz'][1].shape[0], grid['xyz'][0].shape[0],
-                             grid['xyz'][2].shape[0]).transpose([1, 0, 2]),
-            level=mc_value,
-            spacing=(grid['xyz'][0][2] - grid['xyz'][0][1],
-                     grid['xyz'][0][2] - grid['xyz'][0][1],
-                     grid['xyz'][0][2] - grid['xyz'][0][1]))
+    else:
+        raise Exception('no known mesh extraction of type "{}"'.format(extraction))
 
-        verts = verts + np.array([grid['xyz'][0][0],grid['xyz'][1][0],grid['xyz'][2][0]])
-        if (save_ply):
-            meshexport = trimesh.Trimesh(verts, faces, normals, vertex_colors=values)
-            if connected:
-                connected_comp = meshexport.split(only_watertight=False)
-                max_area = 0
-                max_comp = None
-                for comp in connected_comp:
-                    if comp.area > max_area:
-                        max_area = comp.area
-                        max_comp = comp
-                meshexport = max_comp
+    return {"volume": z,
+            "spacing": grid.spacing,
+            "origin": grid.origin}
 
-        def tri_indices(simplices):
-            return ([triplet[c] for triplet in simplices] for c in range(3))
 
-        I, J, K = tri_indices(faces)
+def build_surface_trace(surface, mc_value, save_ply, connected=False, with_trace=True):
+    # the mesh (save_ply) and the plotly trace (with_trace, only needed for the html) of a get_surface result
 
-        trace.append(go.Mesh3d(x=verts[:, 0], y=verts[:, 1], z=verts[:, 2],
-                          i=I, j=J, k=K, name='',
-                          color='orange', opacity=0.5))
+    trace = []
+    meshexport = None
 
+    if ("volume" in surface):
+        surface = meshing.get_volume_surface(surface["volume"], surface["spacing"], surface["origin"], mc_value)
+    else:
+        surface = surface["surface"]
+
+    if (not surface is None):
+
+        verts, faces, normals, values = surface
+
+        if (save_ply):
+            meshexport = meshing.get_mesh(surface, connected)
 
+        if (with_trace):
+            trace.append(go.Mesh3d(x=verts[:, 0], y=verts[:, 1], z=verts[:, 2],
+                              i=faces[:, 0], j=faces[:, 1], k=faces[:, 2], name='',
+                              color='orange', opacity=0.5))
 
     return {"mesh_trace":trace,
             "mesh_export":meshexport}
 
 
-def plot_cuts_axis(points,decoder,latent,path,epoch,near_zero,axis,file_name_sep='/'):
+def get_cuts(decoder, latent, onedim_cut, cuts, chunk_size=100000):
+    """
+    Evaluate the decoder on every slice of cuts = {axis: positions} in one batched pass.
+
+    Returns {axis: (len(positions), n, n)} where a slice is indexed [second free axis, first free axis],
+    the layout of the contour plots.
+    """
+    grids = {axis: get_grid_cut(onedim_cut, axis, positions) for axis, positions in cuts.items()}
+    pnts = torch.cat([grid.grid_points for grid in grids.values()], dim=0)
+    z = meshing.eval_sdf(decoder, pnts, latent, chunk_size).cpu().numpy()
+
+    slices = {}
+    for (axis, grid), z_axis in zip(grids.items(), np.split(z, np.cumsum([grid.num_points for grid in grids.values()])[:-1])):
+        slices[axis] = np.moveaxis(z_axis.reshape(grid.shape), axis, 0).transpose([0, 2, 1])
+    return slices
+
+
+def save_cuts_raster(filename, onedim_cut, slices, positions, output, near_zero):
+    if (output == 'npz'):
+        np.savez_compressed(filename + '.npz', onedim_cut=onedim_cut, positions=positions, slices=slices)
+
+    elif (output == 'png'):
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as pyplot
+
+        vmax = 0.1 if near_zero else np.abs(slices).max()
+        for index, z in enumerate(slices):
+            pyplot.imsave('{0}_{1}.png'.format(filename, index), z, cmap='RdBu', vmin=-vmax, vmax=vmax, origin='lower')
+
+    else:
+        raise Exception('no known cuts output of type "{}"'.format(output))
+
+
+def plot_cuts_axis(points,decoder,latent,path,epoch,near_zero,axis,file_name_sep='/',output='npz'):
     onedim_cut = np.linspace(-1.0, 1.0, 200)
-    xx, yy = np.meshgrid(onedim_cut, onedim_cut)
-    xx = xx.ravel()
-    yy = yy.ravel()
     min_axis = points[:,axis].min(dim=0)[0].item()
     max_axis = points[:,axis].max(dim=0)[0].item()
-    mask = np.zeros(3)
-    mask[axis] = 1.0
-    if (axis == 0):
-        position_cut = np.vstack(([np.zeros(xx.shape[0]), xx, yy]))
-    elif (axis == 1):
-        position_cut = np.vstack(([xx,np.zeros(xx.shape[0]), yy]))
-    elif (axis == 2):
-        position_cut = np.vstack(([xx, yy, np.zeros(xx.shape[0])]))
-    position_cut = [position_cut + i*mask.reshape(-1, 1) for i in np.linspace(min_axis - 0.1, max_axis + 0.1, 50)]
-    for index, pos in enumerate(position_cut):
-        #fig = tools.make_subplots(rows=1, cols=1)
+    position_cut = np.linspace(min_axis - 0.1, max_axis + 0.1, 50)
 
-        field_input = utils.to_cuda(torch.tensor(pos.T, dtype=torch.float))
-        z = []
-        for i, pnts in enumerate(torch.split(field_input, 10000, dim=0)):
-            if (not latent is None):
-                pnts = torch.cat([latent.expand(pnts.shape[0], -1), pnts], dim=1)
-            z.append(decoder(pnts).detach().cpu().numpy())
-        z = np.concatenate(z, axis=0)
+    slices = get_cuts(decoder, latent, onedim_cut, {axis: position_cut})[axis]
+
+    if (output != 'html'):
+        save_cuts_raster('{0}{1}cutsaxis_{2}_{3}'.format(path,file_name_sep,axis, epoch), onedim_cut, slices, position_cut, output, near_zero)
+        return
+
+    for index, (position, z) in enumerate(zip(position_cut, slices)):
+        #fig = tools.make_subplots(rows=1, cols=1)
 
         if (near_zero):
             if (np.min(z) < -1.0e-5):
@@ -200,8 +260,8 @@ def plot_cuts_axis(points,decoder,latent,path,epoch,near_zero,axis,file_name_sep
                 start = 0.0
             trace1 = go.Contour(x=onedim_cut,
                                 y=onedim_cut,
-                                z=z.reshape(onedim_cut.shape[0], onedim_cut.shape[0]),
-                                name='axis {0} = {1}'.format(axis,pos[axis, 0]),  # colorbar=dict(len=0.4, y=0.8),
+                                z=z,
+                                name='axis {0} = {1}'.format(axis,position),  # colorbar=dict(len=0.4, y=0.8),
                                 autocontour=False,
                                 contours=dict(
                                      start=start,
@@ -213,8 +273,8 @@ def plot_cuts_axis(points,decoder,latent,path,epoch,near_zero,axis,file_name_sep
         else:
             trace1 = go.Contour(x=onedim_cut,
                                 y=onedim_cut,
-                                z=z.reshape(onedim_cut.shape[0], onedim_cut.shape[0]),
-                                name='axis {0} = {1}'.format(axis,pos[axis, 0]),  # colorbar=dict(len=0.4, y=0.8),
+                                z=z,
+                                name='axis {0} = {1}'.format(axis,position),  # colorbar=dict(len=0.4, y=0.8),
                                 autocontour=True,
                                 ncontours=70
                                 # contours=dict(
@@ -228,7 +288,7 @@ def plot_cuts_axis(points,decoder,latent,path,epoch,near_zero,axis,file_name_sep
         layout = go.Layout(width=1200, height=1200, scene=dict(xaxis=dict(range=[-1, 1], autorange=False),
                                                                yaxis=dict(range=[-1, 1], autorange=False),
                                                                aspectratio=dict(x=1, y=1)),
-                           title=dict(text='axis {0} = {1}'.format(axis,pos[axis, 0])))
+                           title=dict(text='axis {0} = {1}'.format(axis,position)))
         # fig['layout']['xaxis2'].update(range=[-1, 1])
         # fig['layout']['yaxis2'].update(range=[-1, 1], scaleanchor="x2", scaleratio=1)
 
@@ -237,32 +297,26 @@ def plot_cuts_axis(points,decoder,latent,path,epoch,near_zero,axis,file_name_sep
         offline.plot(fig1, filename=filename, auto_open=False)
 
 
-def plot_cuts(points,decoder,path,epoch,near_zero,latent=None):
+def plot_cuts(points,decoder,path,epoch,near_zero,latent=None,output='npz'):
     onedim_cut = np.linspace(-1, 1, 200)
-    xx, yy = np.meshgrid(onedim_cut, onedim_cut)
-    xx = xx.ravel()
-    yy = yy.ravel()
     min_y = points[:,-2].min(dim=0)[0].item()
     max_y = points[:,-2].max(dim=0)[0].item()
-    position_cut = np.vstack(([xx, np.zeros(xx.shape[0]), yy]))
-    position_cut = [position_cut + np.array([0., i, 0.]).reshape(-1, 1) for i in np.linspace(min_y - 0.1, max_y + 0.1, 10)]
-    for index, pos in enumerate(position_cut):
-        #fig = tools.make_subplots(rows=1, cols=1)
+    position_cut = np.linspace(min_y - 0.1, max_y + 0.1, 10)
 
-        field_input = torch.tensor(pos.T, dtype=torch.float).cuda()
-        z = []
-        for i, pnts in enumerate(torch.split(field_input, 1000, dim=-1)):
-            input_=pnts
-            if (not latent is None):
-                input_ = torch.cat([latent.expand(pnts.shape[0],-1) ,pnts],dim=1)
-            z.append(decoder(input_).detach().cpu().numpy())
-        z = np.concatenate(z, axis=0)
+    slices = get_cuts(decoder, latent, onedim_cut, {1: position_cut})[1]
+
+    if (output != 'html'):
+        save_cuts_raster('{0}/cuts{1}'.format(path, epoch), onedim_cut, slices, position_cut, output, near_zero)
+        return
+
+    for index, (position, z) in enumerate(zip(position_cut, slices)):
+        #fig = tools.make_subplots(rows=1, cols=1)
 
         if (near_zero):
             trace1 = go.Contour(x=onedim_cut,
                                 y=onedim_cut,
-                                z=z.reshape(onedim_cut.shape[0], onedim_cut.shape[0]),
-                                name='y = {0}'.format(pos[1, 0]),  # colorbar=dict(len=0.4, y=0.8),
+                                z=z,
+                                name='y = {0}'.format(position),  # colorbar=dict(len=0.4, y=0.8),
                                 autocontour=False,
                                 contours=dict(
                                      start=-0.001,
@@ -274,8 +328,8 @@ def plot_cuts(points,decoder,path,epoch,near_zero,latent=None):
         else:
             trace1 = go.Contour(x=onedim_cut,
                                 y=onedim_cut,
-                                z=z.reshape(onedim_cut.shape[0], onedim_cut.shape[0]),
-                                name='y = {0}'.format(pos[1, 0]),  # colorbar=dict(len=0.4, y=0.8),
+                                z=z,
+                                name='y = {0}'.format(position),  # colorbar=dict(len=0.4, y=0.8),
                                 autocontour=True,
                                 # contours=dict(
                                 #      start=-0.001,
@@ -288,7 +342,7 @@ def plot_cuts(points,decoder,path,epoch,near_zero,latent=None):
         layout = go.Layout(width=1200, height=1200, scene=dict(xaxis=dict(range=[-1, 1], autorange=False),
                                                                yaxis=dict(range=[-1, 1], autorange=False),
                                                                aspectratio=dict(x=1, y=1)),
-                           title=dict(text='y = {0}'.format(pos[1, 0])))
+                           title=dict(text='y = {0}'.format(position)))
         # fig['layout']['xaxis2'].update(range=[-1, 1])
         # fig['layout']['yaxis2'].update(range=[-1, 1], scaleanchor="x2", scaleratio=1)
 
@@ -322,12 +376,9 @@ def get_grid(points,resolution):
         x = np.arange(input_min[0] - eps, input_max[0] + length / (z.shape[0] - 1) + eps, length / (z.shape[0] - 1))
         y = np.arange(input_min[1] - eps, input_max[1] + length / (z.shape[0] - 1) + eps, length / (z.shape[0] - 1))
 
-    xx, yy, zz = np.meshgrid(x, y, z)
-    grid_points = torch.tensor(np.vstack([xx.ravel(), yy.ravel(), zz.ravel()]).T, dtype=torch.float).cuda()
-    return {"grid_points":grid_points,
-            "shortest_axis_length":length,
-            "xyz":[x,y,z],
-            "shortest_axis_index":shortest_axis}
+    return Grid(xyz=[x,y,z],
+                shortest_axis_length=length,
+                shortest_axis_index=shortest_axis)
 
 
 def get_grid_uniform(resolution):
@@ -335,10 +386,34 @@ def get_grid_uniform(resolution):
     y = x
     z = x
 
-    xx, yy, zz = np.meshgrid(x, y, z)
-    grid_points = utils.to_cuda(torch.tensor(np.vstack([xx.ravel(), yy.ravel(), zz.ravel()]).T, dtype=torch.float))
-
-    return {"grid_points": grid_points,
-            "shortest_axis_length": 2.4,
-            "xyz": [x, y, z],
-            "shortest_axis_index": 0}
\ No newline at end of file
+    return Grid(xyz=[x, y, z],
+                shortest_axis_length=2.4,
+                shortest_axis_index=0)
+
+
+def get_grid_cut(onedim_cut, axis, positions):
+    xyz = [onedim_cut, onedim_cut, onedim_cut]
+    xyz[axis] = np.atleast_1d(positions)
+    return Grid(xyz=xyz)
+
+
+def plot_training_metrics(metrics_file, path, keys=None):
+    # one png per logged scalar against the step, read back from the metrics log
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as pyplot
+
+    records = metrics.read_metrics(metrics_file)
+    if keys is None:
+        keys = [key for key in records[0].keys() if not key in ('step', 'num_steps', 'passes')] if len(records) > 0 else []
+
+    for key in keys:
+        steps = [record['step'] for record in records if key in record]
+        values = [record[key] for record in records if key in record]
+        pyplot.figure(figsize=(10, 8))
+        pyplot.plot(steps, values, label=key)
+        pyplot.xlabel('step')
+        pyplot.legend()
+        pyplot.tight_layout()
+        pyplot.savefig(os.path.join(path, '{0}.png'.format(key)))
+        pyplot.close()
@@ -0,0 +1,155 @@
+import os
+import glob
+import hashlib
+import concurrent.futures
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def content_hash(array):
+    # short digest of the array values, keys caches derived from a point cloud
+    return hashlib.sha1(np.ascontiguousarray(array).view(np.uint8)).hexdigest()[:16]
+
+
+def get_cache_dir():
+    # caches derived from the input point clouds, kept out of the data folders: $IGR_CACHE_DIR or ~/.cache/igr,
+    # None (no caching) when it cannot be created
+    cache_dir = os.environ.get('IGR_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'igr'))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError as e:
+        print('no cache directory: {0}'.format(e))
+        return None
+    return cache_dir
+
+
+def compute_local_sigma(points, k=50, chunk_size=1000000):
+    """
+    Distance of every point to its k-th nearest neighbour (not counting the point itself). Only the
+    k-th neighbour is requested from the KD-tree, and the queries run on all cores one chunk of
+    points at a time, so memory stays at O(chunk_size).
+    """
+    points = np.ascontiguousarray(points[:, :3], dtype=np.float64)
+    tree = cKDTree(points)
+    sigmas = np.empty(points.shape[0], dtype=np.float32)
+
+    for start in range(0, points.shape[0], chunk_size):
+        distances, _ = tree.query(points[start:start + chunk_size], [k + 1], workers=-1)
+        sigmas[start:start + chunk_size] = distances[:, 0]
+
+    return sigmas
+
+
+def get_local_sigma(points, k=50, cache_dir=None):
+    """
+    compute_local_sigma, cached in cache_dir as local_sigma_<hash of the points>_k<k>.npy.
+    The cache is skipped when cache_dir is None or not writable.
+    """
+    points = np.ascontiguousarray(points[:, :3], dtype=np.float32)
+    filename = None if cache_dir is None else os.path.join(cache_dir, 'local_sigma_{0}_k{1}.npy'.format(content_hash(points), k))
+
+    if not filename is None and os.path.exists(filename):
+        print('loading local sigma from {0}'.format(filename))
+        return np.load(filename)
+
+    sigmas = compute_local_sigma(points, k)
+
+    if not filename is None:
+        try:
+            # written to a temporary file first, concurrent runs never read a partial cache
+            np.save(filename + '.tmp.npy', sigmas)
+            os.replace(filename + '.tmp.npy', filename)
+        except OSError as e:
+            print('local sigma not cached: {0}'.format(e))
+
+    return sigmas
+
+
+def split_text_file(filename, chunk_bytes):
+    # byte ranges of about chunk_bytes, ending on line breaks
+    size = os.path.getsize(filename)
+    ranges = []
+    with open(filename, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((filename, start, end))
+            start = end
+    return ranges
+
+
+def parse_text_range(filename, start, end):
+    # whitespace separated values of a byte range, parsed by numpy in one call
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start)
+    values = np.fromstring(text, dtype=np.float32, sep=' ')
+    lines = text.strip().splitlines()
+    if len(lines) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    columns = len(lines[0].split())
+    if values.shape[0] != len(lines) * columns:
+        raise Exception('could not parse {0} as {1} whitespace separated columns'.format(filename, columns))
+    return values.reshape(-1, columns)
+
+
+def read_text_point_clouds(filenames, workers=None, chunk_bytes=2 ** 25):
+    """
+    Parse text point clouds (one point per line, all columns kept) with a process pool over
+    newline aligned chunks of every file. Returns one float32 array per file.
+    """
+    ranges = [r for filename in filenames for r in split_text_file(filename, chunk_bytes)]
+
+    if len(ranges) > 1 and workers != 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            chunks = list(pool.map(parse_text_range, *zip(*ranges)))
+    else:
+        chunks = [parse_text_range(*r) for r in ranges]
+
+    arrays = []
+    for filename in filenames:
+        parts = [chunk for r, chunk in zip(ranges, chunks) if r[0] == filename and chunk.shape[0] > 0]
+        arrays.append(np.concatenate(parts, axis=0) if len(parts) > 0 else np.zeros((0, 3), dtype=np.float32))
+    return arrays
+
+
+def load_point_clouds(path, ext='xyz', cache=True, workers=None):
+    """
+    All .<ext> point clouds of the folder path (or the single file path) stacked into one float32
+    (N, C) array, keeping every column (e.g. normals).
+
+    Text files are parsed once and cached as a .npy in get_cache_dir(), keyed by the paths, sizes
+    and modification times of the files. Later loads memory-map the cache copy-on-write
+    (mmap_mode='c'): nothing is read up front, and writes to the array never reach the cache.
+    """
+    filenames = sorted(glob.glob(os.path.join(path, '*.{0}'.format(ext)))) if os.path.isdir(path) else [path]
+    if len(filenames) == 0:
+        raise Exception('no point cloud files of type "{0}" in {1}'.format(ext, path))
+
+    if ext == 'npy':
+        arrays = [np.load(filename, mmap_mode='c') for filename in filenames]
+        return (arrays[0] if len(arrays) == 1 else np.concatenate(arrays, axis=0)).astype(np.float32, copy=False)
+
+    cache_dir = get_cache_dir() if cache else None
+    key = hashlib.sha1(repr([(os.path.abspath(f), os.path.getsize(f), os.path.getmtime(f)) for f in filenames]).encode()).hexdigest()[:16]
+    cache_file = None if cache_dir is None else os.path.join(cache_dir, 'points_{0}.npy'.format(key))
+
+    if not cache_file is None and os.path.exists(cache_file):
+        return np.load(cache_file, mmap_mode='c')
+
+    arrays = read_text_point_clouds(filenames, workers)
+    if len(set(array.shape[1] for array in arrays)) > 1:
+        raise Exception('point cloud files with different columns in {0}: {1}'.format(
+            path, {os.path.basename(f): array.shape[1] for f, array in zip(filenames, arrays)}))
+    points = np.concatenate(arrays, axis=0)
+
+    if not cache_file is None:
+        try:
+            np.save(cache_file + '.tmp.npy', points)
+            os.replace(cache_file + '.tmp.npy', cache_file)
+        except OSError as e:
+            print('point cloud not cached: {0}'.format(e))
+
+    return points